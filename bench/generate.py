@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import argparse
+import cPickle
+import os
+import random
+from datetime import datetime, timedelta
+
+_words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+          'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor', 'python',
+          'wsgi', 'cache', 'index')
+
+
+def build_thread(count, fan_out, depth, rnd):
+    comments, created = list(), 0
+    frontier = [(comments, 0)]
+    start = datetime(2015, 3, 14, 9, 26)
+    while created < count:
+        replies, level = frontier.pop(0) if frontier else (comments, 0)
+        for _ in xrange(fan_out):
+            if created == count:
+                break
+            comment = (start + timedelta(minutes=created), 'reader@example.com',
+                       'reader %d' % created,
+                       ' '.join(rnd.choice(('lorem', 'ipsum', 'dolor', 'sit',
+                                            'amet', '<b>', '&'))
+                                for _ in xrange(30)), [])
+            replies.append(comment)
+            created += 1
+            if level + 1 < depth:
+                frontier.append((comment[4], level + 1))
+    return comments
+
+
+def paragraph(rnd, words):
+    return '<p>%s</p>\n' % ' '.join(rnd.choice(_words) for _ in xrange(words))
+
+
+def shard_dir(root, date, sharded):
+    if not sharded:
+        return root
+    path = os.path.join(root, date.strftime('%Y'), date.strftime('%m'))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def write_entry(entries_dir, pid, date, categories, rnd, with_full):
+    file_name = '%s-%s.txt' % (pid, date.strftime('%Y-%m-%d'))
+    with open(os.path.join(entries_dir, file_name), 'w') as f:
+        f.write('title: %s\n' % pid.replace('-', ' ').capitalize())
+        f.write('categories: %s\n' % ', '.join(categories))
+        f.write('preview:\n')
+        for _ in xrange(2):
+            f.write(paragraph(rnd, 60))
+        if with_full:
+            f.write('full:\n')
+            for _ in xrange(12):
+                f.write(paragraph(rnd, 120))
+    return file_name
+
+
+def generate(root, posts, categories, comments, fan_out, depth, seed=42,
+             sharded=False):
+    rnd = random.Random(seed)
+    paths = dict((name, os.path.join(root, name))
+                 for name in ('entries', 'indices', 'comments'))
+    for path in paths.itervalues():
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    names = ['category-%d' % number for number in xrange(categories)]
+    start = datetime(2010, 1, 1)
+    for number in xrange(posts):
+        date = start + timedelta(days=number * 3650 // max(posts, 1))
+        pid = 'post-%d' % number
+        write_entry(shard_dir(paths['entries'], date, sharded), pid, date,
+                    rnd.sample(names, min(len(names), rnd.randint(1, 3))),
+                    rnd, number % 2 == 0)
+        if comments:
+            thread = build_thread(rnd.randint(0, comments), fan_out, depth,
+                                  rnd)
+            if thread:
+                file_name = '%s-%s.comments' % (pid,
+                                                date.strftime('%Y-%m-%d'))
+                with open(os.path.join(shard_dir(paths['comments'], date,
+                                                 sharded), file_name),
+                          'wb') as f:
+                    cPickle.dump(thread, f, protocol=cPickle.HIGHEST_PROTOCOL)
+    conf_path = os.path.join(root, 'index.conf')
+    with open(conf_path, 'w') as f:
+        f.write('title = %r\n' % 'Benchmark')
+        f.write('entries_path = %r\n' % paths['entries'])
+        f.write('indices_path = %r\n' % paths['indices'])
+        f.write('comments_path = %r\n' % paths['comments'])
+        f.write('password = %r\n' % 'benchmark')
+        f.write('salt = %r\n' % '0123456789ABCDEF')
+        if sharded:
+            f.write('sharded_layout = True\n')
+    return conf_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fills a directory with a '
+                                                 'synthetic blog for the '
+                                                 'benchmarks')
+    parser.add_argument('root')
+    parser.add_argument('-p', '--posts', type=int, default=1000)
+    parser.add_argument('-m', '--categories', type=int, default=20)
+    parser.add_argument('-c', '--comments', type=int, default=40,
+                        help='upper bound of comments per post')
+    parser.add_argument('-f', '--fan-out', type=int, default=3)
+    parser.add_argument('-d', '--depth', type=int, default=4)
+    parser.add_argument('-s', '--seed', type=int, default=42)
+    parser.add_argument('--sharded', action='store_true',
+                        help='write entries and comments into year/month '
+                             'directories')
+    args = parser.parse_args()
+    conf_path = generate(args.root, args.posts, args.categories,
+                         args.comments, args.fan_out, args.depth, args.seed,
+                         args.sharded)
+    print 'configuration written to %s' % conf_path
+
+
+if __name__ == '__main__':
+    main()
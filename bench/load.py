@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import argparse
+import gc
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import timeit
+from StringIO import StringIO
+from urllib import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+import index
+from index import Blog, LRUCache
+
+
+class OpenCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+        return open(*args, **kwargs)
+
+
+def build_environ(method, path, body=''):
+    path, _, query = path.partition('?')
+    return {'REQUEST_METHOD': method, 'PATH_INFO': path,
+            'QUERY_STRING': query, 'SCRIPT_NAME': '',
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+            'HTTP_HOST': 'localhost', 'HTTP_ACCEPT_ENCODING': 'gzip',
+            'wsgi.url_scheme': 'http', 'wsgi.input': StringIO(body),
+            'CONTENT_LENGTH': str(len(body)),
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded'}
+
+
+def build_routes(blog):
+    entries = blog.index
+    dates = [entry.date.strftime('%Y-%m-%d') for entry in entries]
+    category = max(blog._category_positions,
+                   key=lambda name: len(blog._category_positions[name]))
+    archive = blog.archive[len(blog.archive) // 2]
+    posts = ['/post/%s/%s' % (dates[position], entries[position].pid)
+             for position in xrange(0, len(entries),
+                                    max(1, len(entries) // 16))]
+    commented = max(xrange(len(entries)), key=lambda position:
+                    blog.comment_count(dates[position], entries[position].pid))
+    m = hashlib.sha1()
+    m.update(dates[commented] + entries[commented].pid + blog._salt)
+    comment = urlencode({'name': 'bench', 'email': 'bench@example.com',
+                         'comment': 'benchmark comment', 'comment_no': '',
+                         'cobweb': m.hexdigest()})
+    return [('list', 'GET', ['/'], ''),
+            ('list page', 'GET', ['/page/2', '/page/3'], ''),
+            ('category', 'GET', ['/category/' + category], ''),
+            ('archive', 'GET', ['/archive/' + archive], ''),
+            ('post', 'GET', posts, ''),
+            ('rss', 'GET', ['/rss'], ''),
+            ('rss category', 'GET', ['/rss/' + category], ''),
+            ('search', 'GET', ['/search?q=python+cache'], ''),
+            ('comment', 'POST', ['/post/%s/%s' % (dates[commented],
+                                                  entries[commented].pid)],
+             comment)]
+
+
+def percentile(values, rank):
+    return values[max(0, int(math.ceil(rank / 100.0 * len(values))) - 1)]
+
+
+def measure(blog, method, paths, body, requests):
+    counter = OpenCounter()
+    latencies, opens, objects, sent = list(), 0, 0, 0
+    statuses = dict()
+
+    def start_response(status, headers, exc_info=None):
+        statuses[status] = statuses.get(status, 0) + 1
+
+    index.open = counter
+    gc.disable()
+    try:
+        for number in xrange(requests):
+            environ = build_environ(method, paths[number % len(paths)], body)
+            gc.collect()
+            allocated, counter.count = gc.get_count()[0], 0
+            started = timeit.default_timer()
+            sent += sum(len(chunk) for chunk in blog(environ, start_response))
+            latencies.append(timeit.default_timer() - started)
+            objects += gc.get_count()[0] - allocated
+            opens += counter.count
+    finally:
+        gc.enable()
+        del index.open
+    latencies.sort()
+    return {'requests': requests,
+            'throughput': requests / sum(latencies),
+            'p50': percentile(latencies, 50) * 1e3,
+            'p95': percentile(latencies, 95) * 1e3,
+            'p99': percentile(latencies, 99) * 1e3,
+            'opens': float(opens) / requests,
+            'objects': float(objects) / requests,
+            'bytes': sent // requests,
+            'statuses': statuses}
+
+
+def report(results, baseline, tolerance):
+    print '%-13s %9s %8s %8s %8s %7s %9s %8s' % (
+        'route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'opens', 'objects',
+        'bytes')
+    regressions = list()
+    for name, result in results:
+        line = '%-13s %9.1f %8.3f %8.3f %8.3f %7.2f %9.1f %8d' % (
+            name, result['throughput'], result['p50'], result['p95'],
+            result['p99'], result['opens'], result['objects'],
+            result['bytes'])
+        previous = baseline.get(name)
+        if previous:
+            change = (result['p50'] - previous['p50']) / previous['p50']
+            line += ' %+6.1f%% p50' % (change * 100)
+            if change > tolerance:
+                regressions.append(name)
+        print line
+    if regressions:
+        print 'slower than the baseline: %s' % ', '.join(regressions)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drives Blog.__call__ over '
+                                                 'every route and reports '
+                                                 'latency, throughput, file '
+                                                 'opens and allocations')
+    parser.add_argument('conf', help='index.conf written by generate.py')
+    parser.add_argument('-n', '--requests', type=int, default=500,
+                        help='requests per route')
+    parser.add_argument('-w', '--warmup', type=int, default=20)
+    parser.add_argument('--cold', action='store_true',
+                        help='disable the response cache')
+    parser.add_argument('--save', help='write results as a baseline')
+    parser.add_argument('--baseline', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed p50 slowdown against the baseline')
+    args = parser.parse_args()
+    blog = Blog(args.conf)
+    logging.disable(logging.INFO)
+    if args.cold:
+        blog._responses = LRUCache(0)
+    results = list()
+    for name, method, paths, body in build_routes(blog):
+        if method == 'GET':
+            measure(blog, method, paths, body, args.warmup)
+        results.append((name, measure(blog, method, paths, body,
+                                      args.requests)))
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(results), f, indent=2, sort_keys=True)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
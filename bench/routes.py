@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+from index import Blog
+
+_paths = [('GET', '/'), ('GET', '/'), ('GET', '/'), ('GET', '/page/2'),
+          ('GET', '/post/2015-03-14/pi-day'),
+          ('GET', '/post/2015-03-14/pi-day'),
+          ('GET', '/post/2014-11-02/hello%2C+world'),
+          ('GET', '/category/python'), ('GET', '/category/python/page/3'),
+          ('GET', '/archive/2015-03'), ('GET', '/archive/2015-03/page/2'),
+          ('GET', '/rss'), ('GET', '/rss'), ('GET', '/rss/python'),
+          ('GET', '/post/2015-03-14/pi-day/admin'),
+          ('GET', '/delete/2015-03-14/pi-day/0-2'),
+          ('POST', '/post/2015-03-14/pi-day'),
+          ('POST', '/delete/2015-03-14/pi-day/1'),
+          ('GET', '/favicon.ico'), ('GET', '/no/such/page')]
+
+
+def legacy_match(method, path):
+    if method == 'GET':
+        if not path or path == '/':
+            return 'cached_list', {}
+        elif re.match('^/page/\d+/?$', path):
+            return 'cached_list', {'page': int(path.split('/')[2])}
+        elif re.match('^/category/[^/]+/?$', path):
+            return 'cached_list', {'category': path.split('/')[2]}
+        elif re.match('^/category/[^/]+/page/\d+/?$', path):
+            path_els = path.split('/')
+            return 'cached_list', {'category': path_els[2],
+                                   'page': int(path_els[4])}
+        elif re.match('^/archive/\d{4}-\d{2}/?$', path):
+            return 'cached_list', {'archive': path.split('/')[2]}
+        elif re.match('^/archive/\d{4}-\d{2}/page/\d+/?$', path):
+            path_els = path.split('/')
+            return 'cached_list', {'archive': path_els[2],
+                                   'page': int(path_els[4])}
+        elif re.match('^/post/\d{4}-\d{2}-\d{2}/[^/]+/?$', path):
+            path_els = path.split('/')
+            return 'cached_post', {'archive': path_els[2],
+                                   'pid': path_els[3]}
+        elif re.match('^/post/\d{4}-\d{2}-\d{2}/[^/]+/admin/?$', path):
+            path_els = path.split('/')
+            return 'cached_post', {'archive': path_els[2],
+                                   'pid': path_els[3], 'admin': True}
+        elif re.match('^/delete/\d{4}-\d{2}-\d{2}/[^/]+/\d+(-\d+)*/?$',
+                      path):
+            path_els = path.split('/')
+            return 'get_delete_comment', {'archive': path_els[2],
+                                          'pid': path_els[3],
+                                          'ids_str': path_els[4]}
+        elif re.match('^/rss/?$', path):
+            return 'cached_rss', {}
+        elif re.match('^/rss/[^/]+/?$', path):
+            return 'cached_rss', {'category': path.split('/')[2]}
+    elif method == 'POST':
+        if re.match('^/post/\d{4}-\d{2}-\d{2}/[^/]+/?$', path):
+            path_els = path.split('/')
+            return 'post_comment', {'archive': path_els[2],
+                                    'pid': path_els[3]}
+        elif re.match('^/delete/\d{4}-\d{2}-\d{2}/[^/]+/\d+(-\d+)*/?$',
+                      path):
+            path_els = path.split('/')
+            return 'post_delete_comment', {'archive': path_els[2],
+                                           'pid': path_els[3],
+                                           'ids_str': path_els[4]}
+    return None, None
+
+
+def router_match(method, path):
+    return Blog.router.match(method, path)[0:2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the legacy chain '
+                                                 'of re.match calls with '
+                                                 'the compiled router')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='passes over the path mix per measurement')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+    for method, path in _paths:
+        if legacy_match(method, path)[0] != router_match(method, path)[0]:
+            print 'routes differ for %s %s' % (method, path)
+    for name, match in (('legacy', legacy_match), ('router', router_match)):
+        best = min(timeit.repeat(lambda: [match(method, path) for method, path
+                                          in _paths],
+                                 number=args.number, repeat=args.repeat))
+        print '%-8s %8.2f us per request' % (name, best * 1e6 /
+                                             (args.number * len(_paths)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import argparse
+import os
+import random
+import sys
+import timeit
+from string import Template as StringTemplate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+import index
+from bench.generate import build_thread
+from index import Blog
+
+
+def legacy_templates():
+    return dict((name, StringTemplate(value.template))
+                for name, value in vars(Blog).iteritems()
+                if isinstance(value, index.Template))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares rendering a '
+                                                 'comment thread with '
+                                                 'string.Template and the '
+                                                 'pre-split templates')
+    parser.add_argument('-c', '--comments', type=int, default=2000)
+    parser.add_argument('-f', '--fan-out', type=int, default=4)
+    parser.add_argument('-d', '--depth', type=int, default=5)
+    parser.add_argument('-n', '--number', type=int, default=10)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+    blog = Blog(lazy_index=True, watch_index=False)
+    comments = build_thread(args.comments, args.fan_out, args.depth,
+                            random.Random(42))
+    compiled = dict((name, getattr(Blog, name))
+                    for name in legacy_templates())
+
+    def render():
+        return blog.gather_comments('http://example.com', comments,
+                                    '2015-03-14', 'pi-day', 'token', True)
+
+    results = dict()
+    for name, templates in (('string', legacy_templates()),
+                            ('compiled', compiled)):
+        for attr, template in templates.iteritems():
+            setattr(Blog, attr, template)
+        results[name] = render()
+        best = min(timeit.repeat(render, number=args.number,
+                                 repeat=args.repeat))
+        print '%-9s %8.2f ms per %d-comment thread' % (
+            name, best * 1e3 / args.number, results[name][1])
+    for attr, template in compiled.iteritems():
+        setattr(Blog, attr, template)
+    if results['string'] != results['compiled']:
+        print 'rendered output differs'
+
+
+if __name__ == '__main__':
+    main()
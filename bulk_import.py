@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import argparse
+import functools
+import itertools
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+from contextlib import closing
+from datetime import datetime
+
+import index
+from index import Blog, Entry
+
+
+class ChunkPool(object):
+    def __init__(self, blog, processes, chunk_size, progress):
+        self.blog = blog
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self._pool = None
+        if processes != 1:
+            self._pool = multiprocessing.Pool(processes, _init_worker,
+                                              (blog.conf_path,))
+
+    def run(self, stage, func, items):
+        chunks = [(stage, items[start:start + self.chunk_size])
+                  for start in xrange(0, len(items), self.chunk_size)]
+        results = self._pool.imap(func, chunks) if self._pool \
+            else itertools.imap(func, chunks)
+        done = 0
+        for (_, chunk), result in itertools.izip(chunks, results):
+            done += len(chunk)
+            self.progress(stage, done, len(items))
+            yield result
+
+    def map(self, method, items):
+        return self.run(method, _call_blog if self._pool else
+                        functools.partial(_call_blog, blog=self.blog), items)
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+
+_worker_blog = None
+
+
+def _init_worker(conf_path):
+    global _worker_blog
+    _worker_blog = Blog(conf_path, lazy_index=True, watch_index=False)
+
+
+def _call_blog(job, blog=None):
+    method, items = job
+    return getattr(blog or _worker_blog, method)(items)
+
+
+def _import_chunk(job):
+    _, jobs = job
+    return [(source, import_file(source, target, dry_run))
+            for source, target, dry_run in jobs]
+
+
+def normalize(data):
+    if data.startswith('\xef\xbb\xbf'):
+        data = data[3:]
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None, 'not UTF-8'
+    data = data.replace('\r\n', '\n').replace('\r', '\n')
+    if data and not data.endswith('\n'):
+        data += '\n'
+    kinds = set(matched.group(1)
+                for matched in Blog._re_section.finditer(data))
+    if 'title' not in kinds:
+        return None, 'no title'
+    if 'preview' not in kinds and 'full' not in kinds:
+        return None, 'no preview or full text'
+    return data, None
+
+
+def import_file(source, target, dry_run=False):
+    try:
+        with open(source, 'rb') as f:
+            data, error = normalize(f.read())
+    except IOError as e:
+        return str(e)
+    if error or dry_run:
+        return error
+    dir_name = os.path.dirname(target)
+    try:
+        if not os.path.isdir(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError:
+                if not os.path.isdir(dir_name):
+                    raise
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=dir_name)
+        try:
+            with closing(os.fdopen(tmp_fd, 'wb')) as tmp_file:
+                tmp_file.write(data)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except (IOError, OSError) as e:
+        return str(e)
+    return None
+
+
+def list_sources(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if file_name.endswith('.txt'):
+                        yield os.path.join(dir_path, file_name)
+        else:
+            yield path
+
+
+def plan_import(blog, sources, replace=False):
+    re_file_name = re.compile('^(.+)' + re.escape(blog.file_name_sep) +
+                              '(\d{4}-\d{2}-\d{2})\.txt$')
+    jobs, errors, targets = list(), list(), dict()
+    for source in sources:
+        matched = re_file_name.match(os.path.basename(source))
+        try:
+            date = datetime.strptime(matched.group(2), '%Y-%m-%d')
+        except (AttributeError, ValueError):
+            errors.append((source, 'name is not <pid>%s<YYYY-MM-DD>.txt' %
+                           blog.file_name_sep))
+            continue
+        target = os.path.join(blog.entries_dir, blog.build_file_name(
+            Entry(date.toordinal(), matched.group(1), ())))
+        if target in targets:
+            errors.append((source, 'same post as %s' % targets[target]))
+        elif not replace and os.path.exists(target):
+            errors.append((source, 'already exists'))
+        else:
+            targets[target] = source
+            jobs.append((source, target))
+    return jobs, errors
+
+
+def bulk_import(blog, sources, processes=None, chunk_size=256,
+                replace=False, dry_run=False, progress=None):
+    jobs, errors = plan_import(blog, sources, replace)
+    pool = ChunkPool(blog, processes, chunk_size,
+                     progress or (lambda stage, done, total: None))
+    try:
+        imported = 0
+        for chunk in pool.run('import', _import_chunk,
+                              [(source, target, dry_run)
+                               for source, target in jobs]):
+            for source, error in chunk:
+                if error:
+                    errors.append((source, error))
+                else:
+                    imported += 1
+        if not dry_run:
+            blog._chunk_pool = pool
+            try:
+                with blog._state_lock:
+                    blog._apply_index(*blog._create_main_index(
+                        os.path.join(blog.indices_dir, 'main.index')))
+                    blog._sync_search()
+            finally:
+                blog._chunk_pool = None
+    finally:
+        pool.close()
+    return imported, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validates, normalizes and '
+                                                 'copies entry files into the '
+                                                 'blog and rebuilds the '
+                                                 'indices with a pool of '
+                                                 'processes')
+    parser.add_argument('sources', nargs='+',
+                        help='entry files or directories holding them')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('-c', '--chunk-size', type=int, default=256,
+                        help='files handed to a worker at a time')
+    parser.add_argument('--replace', action='store_true',
+                        help='overwrite entries that already exist')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only validate the files')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args()
+    labels = {'import': 'importing', '_read_all_metadata': 'indexing',
+              '_search_docs': 'search indexing'}
+
+    def progress(stage, done, total):
+        sys.stderr.write('\r%-16s %d/%d' % (labels[stage], done, total))
+        if done == total:
+            sys.stderr.write('\n')
+
+    imported, errors = bulk_import(index.application,
+                                   list_sources(args.sources),
+                                   args.processes, args.chunk_size,
+                                   args.replace, args.dry_run,
+                                   None if args.quiet else progress)
+    for source, error in errors:
+        print '%s: %s' % (source, error)
+    print '%d files %s, %d rejected' % (
+        imported, 'valid' if args.dry_run else 'imported', len(errors))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
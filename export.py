@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import argparse
+import cPickle
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from contextlib import closing
+from urllib import quote_plus
+from urlparse import urlsplit
+
+import index
+from index import RequestContext
+
+_manifest_name = '.export.manifest'
+
+
+class Page(object):
+    def __init__(self, path, renderer, kwargs, signature):
+        self.path = path
+        self.renderer = renderer
+        self.kwargs = kwargs
+        self.signature = signature
+
+    def file_name(self, out_dir):
+        parts = [part for part in self.path.split('/') if part]
+        name = 'index.xml' if self.renderer == 'get_rss' else 'index.html'
+        return os.path.join(out_dir, *(parts + [name]))
+
+
+def _environ(base_uri, path):
+    scheme, netloc, script_name, _, _ = urlsplit(base_uri)
+    return {'wsgi.url_scheme': scheme or 'http', 'HTTP_HOST': netloc,
+            'SCRIPT_NAME': script_name.rstrip('/'), 'PATH_INFO': path,
+            'REQUEST_METHOD': 'GET'}
+
+
+def _signature(*parts):
+    m = hashlib.sha1()
+    m.update(repr(parts))
+    return m.hexdigest()
+
+
+def _entry_version(blog, entry):
+    file_name = blog.build_file_name(entry)
+    return (file_name, blog._index_files.get(file_name),
+            blog.comment_count(entry.date.strftime('%Y-%m-%d'), entry.pid))
+
+
+def list_pages(blog, base_uri, comment_counts=None):
+    pages = list()
+    known_counts = dict(comment_counts or ())
+    if comment_counts is not None:
+        comment_counts.clear()
+    site = (base_uri, blog.title, blog.author, blog.items_per_page,
+            blog.items_per_feed, blog.comments_per_page, blog.categories,
+            blog.archive)
+
+    def add_list(prefix, category=None, archive=None):
+        entries = blog.filter_entries(category, archive)
+        count = len(entries)
+        pages_count = max(1, -(-count // blog.items_per_page))
+        for page in xrange(1, pages_count + 1):
+            items_to = blog.items_per_page * page
+            signature = _signature(site, count, page, [
+                _entry_version(blog, entry) for entry in
+                entries[items_to - blog.items_per_page:items_to]])
+            kwargs = {'category': category, 'archive': archive, 'page': page}
+            if page == 1:
+                pages.append(Page(prefix or '/', 'get_list', kwargs,
+                                  signature))
+            pages.append(Page(prefix + '/page/' + str(page), 'get_list',
+                              kwargs, signature))
+
+    def add_feed(path, category=None):
+        entries = blog.filter_entries(category, None)
+        pages.append(Page(path, 'get_rss', {'category': category},
+                          _signature(site, [
+                              _entry_version(blog, entry) for entry in
+                              entries[:blog.items_per_feed]])))
+
+    add_list('')
+    add_feed('/rss')
+    for category in blog.categories:
+        add_list('/category/' + quote_plus(category), category=category)
+        add_feed('/rss/' + quote_plus(category), category)
+    for archive in blog.archive:
+        add_list('/archive/' + archive, archive=archive)
+    for entry in blog.index:
+        archive = entry.date.strftime('%Y-%m-%d')
+        path = '/post/' + archive + '/' + entry.pid
+        signature = _signature(site, _entry_version(blog, entry),
+                               blog._comment_store.mtime(archive, entry.pid))
+        pages.append(Page(path, 'get_post',
+                          {'archive': archive, 'pid': entry.pid}, signature))
+        if blog.comments_per_page <= 0:
+            continue
+        known = known_counts.get(path)
+        if known and known[0] == signature:
+            count = known[1]
+        else:
+            count = blog._comment_store.load_page(archive, entry.pid, 0, 0)[1]
+        if comment_counts is not None:
+            comment_counts[path] = (signature, count)
+        for page in xrange(2, -(-count // blog.comments_per_page) + 1):
+            pages.append(Page(path + '/comments/page/' + str(page),
+                              'get_post', {'archive': archive,
+                                           'pid': entry.pid, 'page': page},
+                              signature))
+    return pages
+
+
+_worker_blog = None
+
+
+def _init_worker(conf_path):
+    global _worker_blog
+    _worker_blog = index.Blog(conf_path, watch_index=False)
+
+
+def _render_in_worker(job):
+    return _render(_worker_blog, job)
+
+
+def _render(blog, job):
+    page, base_uri, out_dir = job
+    status = []
+    rc = RequestContext(_environ(base_uri, page.path),
+                        lambda code, headers: status.append(code))
+    body = "".join(getattr(blog, page.renderer)(rc, **page.kwargs))
+    if status[0] != blog._statuses[200]:
+        return page.path, False
+    file_name = page.file_name(out_dir)
+    dir_name = os.path.dirname(file_name)
+    if not os.path.isdir(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            if not os.path.isdir(dir_name):
+                raise
+    _write_file(file_name, body)
+    return page.path, True
+
+
+def _write_file(file_name, data):
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_name))
+    try:
+        with closing(os.fdopen(tmp_fd, 'wb')) as tmp_file:
+            tmp_file.write(data)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, file_name)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def export(blog, out_dir, base_uri, processes=None, full=False,
+           chunk_size=16):
+    logger = logging.getLogger(__name__)
+    manifest_path = os.path.join(out_dir, _manifest_name)
+    manifest = dict()
+    if not full and os.path.exists(manifest_path):
+        with open(manifest_path, 'rb') as f:
+            manifest = cPickle.load(f)
+        if manifest.get('base_uri') != base_uri:
+            manifest = dict()
+    signatures = manifest.get('pages', dict())
+    comment_counts = manifest.get('comment_counts', dict())
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    blog.refresh_index()
+    blog._reload_comments_index()
+    pages = list_pages(blog, base_uri, comment_counts)
+    stale = [page for page in pages
+             if signatures.get(page.path) != page.signature or
+             not os.path.exists(page.file_name(out_dir))]
+    stale_paths = set(page.path for page in stale)
+    logger.info('%d of %d pages need rendering', len(stale), len(pages))
+    jobs = [(page, base_uri, out_dir) for page in stale]
+    if processes == 1 or len(jobs) < 2 * chunk_size:
+        results = [_render(blog, job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (blog.conf_path,))
+        try:
+            results = list(pool.imap_unordered(_render_in_worker, jobs,
+                                               chunk_size))
+        finally:
+            pool.close()
+            pool.join()
+    rendered = set(path for path, ok in results if ok)
+    current = dict((page.path, page.signature) for page in pages
+                   if page.path in rendered or page.path not in stale_paths)
+    removed = 0
+    for path in signatures:
+        if path not in current:
+            for name in ('index.html', 'index.xml'):
+                file_name = os.path.join(out_dir, *([part for part in
+                                                     path.split('/') if part]
+                                                    + [name]))
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+                    removed += 1
+    script_path, _ = os.path.split(os.path.realpath(index.__file__))
+    for asset in ('styles.css', 'script.js'):
+        shutil.copyfile(os.path.join(script_path, asset),
+                        os.path.join(out_dir, asset))
+    _write_file(manifest_path, cPickle.dumps({'base_uri': base_uri,
+                                              'pages': current,
+                                              'comment_counts':
+                                              comment_counts},
+                                             cPickle.HIGHEST_PROTOCOL))
+    logger.info('%d pages rendered, %d stale files removed', len(rendered),
+                removed)
+    return len(rendered), removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Renders every list page, '
+                                                 'post and feed of the blog '
+                                                 'into a directory of static '
+                                                 'files')
+    parser.add_argument('out_dir', help='directory to write the site into')
+    parser.add_argument('base_uri', help='absolute URI the site is served '
+                                         'from, e.g. http://example.com/blog')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--full', action='store_true',
+                        help='ignore the manifest and render every page')
+    args = parser.parse_args()
+    rendered, removed = export(index.application, args.out_dir,
+                               args.base_uri.rstrip('/'), args.processes,
+                               args.full)
+    print '%d pages rendered, %d stale files removed' % (rendered, removed)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,28 @@ import os
 import re
 from datetime import datetime
 import cPickle
+import ctypes
+import ctypes.util
+import fcntl
+import mmap
+import select
+import struct
+import threading
+from array import array
+from collections import OrderedDict
 import tempfile
 from contextlib import closing
-from string import Template
+from string import Template as StringTemplate
 import wsgiref.util
 import cgi
-from urllib import quote_plus, unquote_plus
+from urllib import quote_plus, unquote_plus, urlencode
+from urlparse import parse_qs
+from email.utils import formatdate, parsedate_tz, mktime_tz
 import hashlib
 import random
+import stat
+import time
+import zlib
 
 
 class RequestContext(object):
@@ -26,9 +40,1089 @@ class RequestContext(object):
         self.method = self.environ['REQUEST_METHOD'].upper()
 
 
+class Template(StringTemplate):
+    def __init__(self, template):
+        super(Template, self).__init__(template)
+        parts, names, pos = [], [], 0
+        for matched in self.pattern.finditer(template):
+            parts.append(template[pos:matched.start()].replace('%', '%%'))
+            pos = matched.end()
+            if matched.group('escaped') is not None:
+                parts.append(self.delimiter.replace('%', '%%'))
+            elif matched.group('invalid') is not None:
+                self._invalid(matched)
+            else:
+                parts.append('%s')
+                names.append(matched.group('named') or
+                             matched.group('braced'))
+        parts.append(template[pos:].replace('%', '%%'))
+        self._format = ''.join(parts)
+        self._names = tuple(names)
+
+    def split(self, name):
+        head, _, tail = self.template.partition('${%s}' % name)
+        return Template(head), Template(tail)
+
+    def substitute(*args, **kws):
+        if not args:
+            raise TypeError('substitute() needs a template instance')
+        self, args = args[0], args[1:]
+        if len(args) > 1:
+            raise TypeError('Too many positional arguments')
+        if args:
+            mapping = dict(args[0])
+            mapping.update(kws)
+        else:
+            mapping = kws
+        return self._format % tuple([mapping[name] for name in self._names])
+
+
+class LRUCache(object):
+    def __init__(self, max_items, max_bytes=0):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._tags = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=0, tags=()):
+        with self._lock:
+            self._pop(key)
+            if self.max_items <= 0 or 0 < self.max_bytes < size:
+                return
+            tags = frozenset(tags)
+            self._items[key] = (value, size, tags)
+            self.size += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._items) > self.max_items or \
+                    (self.max_bytes and self.size > self.max_bytes):
+                self._pop(next(iter(self._items)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._pop(key, default)
+
+    def _pop(self, key, default=None):
+        try:
+            value, size, tags = self._items.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        return value
+
+    def tags(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            return item[2] if item else frozenset()
+
+    def invalidate(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._tags.clear()
+            self.size = 0
+
+
+class IndexView(object):
+    def __init__(self, entries, positions):
+        self._entries = entries
+        self._positions = positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __iter__(self):
+        entries = self._entries
+        for position in self._positions:
+            yield entries[position]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._entries[position]
+                    for position in self._positions[item]]
+        return self._entries[self._positions[item]]
+
+
+class Watcher(object):
+    _mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    _overflow = 0x4000
+
+    def __init__(self, paths, callback, debounce, poll_interval, logger):
+        self.paths = paths
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.max_delay = max(debounce, 1.0)
+        self.pid = os.getpid()
+        self._logger = logger
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._extra = set()
+        self._libc = None
+        self._fd = None
+        self._watches = dict()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def watch(self, paths):
+        with self._lock:
+            self._extra.update(paths)
+            if self._fd is not None:
+                for path in paths:
+                    self._add_watch(path)
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, path, self._mask)
+        if wd >= 0:
+            self._watches[wd] = path
+
+    def _run(self):
+        fd, watches = self._inotify()
+        if fd is None:
+            self._logger.debug('inotify is not available, polling %s every '
+                               '%s seconds', self.paths, self.poll_interval)
+            while not self._stopping.wait(self.poll_interval):
+                self._notify(set(self.paths))
+            return
+        try:
+            while not self._stopping.is_set():
+                if not select.select([fd], [], [], 1.0)[0]:
+                    continue
+                changed = set()
+                deadline = time.time() + self.max_delay
+                while True:
+                    changed.update(self._read_events(fd, watches))
+                    if time.time() >= deadline or \
+                            not select.select([fd], [], [], self.debounce)[0]:
+                        break
+                self._notify(changed)
+        finally:
+            with self._lock:
+                self._fd = None
+            os.close(fd)
+
+    def _inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return None, None
+        if fd < 0:
+            return None, None
+        watches = dict()
+        for path in self.paths:
+            if os.path.isdir(path):
+                wd = libc.inotify_add_watch(fd, path, self._mask)
+                if wd < 0:
+                    os.close(fd)
+                    return None, None
+                watches[wd] = path
+        with self._lock:
+            self._libc, self._fd, self._watches = libc, fd, watches
+            for path in self._extra:
+                self._add_watch(path)
+        return fd, watches
+
+    def _read_events(self, fd, watches):
+        data = os.read(fd, 64 * 1024)
+        changed, offset = set(), 0
+        while offset + 16 <= len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            offset += 16 + length
+            if mask & self._overflow:
+                changed.update(self.paths)
+            elif wd in watches:
+                changed.add(watches[wd])
+        return changed
+
+    def _notify(self, changed):
+        try:
+            self.callback(changed)
+        except Exception:
+            self._logger.error('watcher callback failed', exc_info=1)
+
+
+class Entry(object):
+    __slots__ = ('ordinal', 'pid', 'categories')
+
+    def __init__(self, ordinal, pid, categories):
+        self.ordinal = ordinal
+        self.pid = pid
+        self.categories = categories
+
+    @property
+    def date(self):
+        return datetime.fromordinal(self.ordinal)
+
+
+class EntryTable(object):
+    __slots__ = ('ordinals', 'pids', 'names', 'sets', 'set_ids',
+                 '_named_sets')
+
+    def __init__(self, ordinals, pids, names, sets, set_ids):
+        self.ordinals = ordinals
+        self.pids = pids
+        self.names = names
+        self.sets = sets
+        self.set_ids = set_ids
+        self._named_sets = [tuple(names[category_id] for category_id in ids)
+                            for ids in sets]
+
+    @classmethod
+    def pack(cls, entries):
+        entries = sorted(entries, reverse=True,
+                         key=lambda entry: (entry.ordinal, entry.pid))
+        names = sorted(set(name for entry in entries
+                           for name in entry.categories))
+        ids = dict((name, category_id)
+                   for category_id, name in enumerate(names))
+        sets, set_ids = dict(), array('i')
+        for entry in entries:
+            key = tuple(sorted(ids[name] for name in entry.categories))
+            set_ids.append(sets.setdefault(key, len(sets)))
+        return cls(array('i', [entry.ordinal for entry in entries]),
+                   [intern(entry.pid) for entry in entries], names,
+                   sorted(sets, key=sets.get), set_ids)
+
+    def dump(self):
+        return (self.ordinals.tostring(), '\n'.join(self.pids), self.names,
+                self.sets, self.set_ids.tostring())
+
+    @classmethod
+    def restore(cls, fields):
+        ordinals, pids, names, sets, set_ids = fields
+        ordinals_array, set_ids_array = array('i'), array('i')
+        ordinals_array.fromstring(ordinals)
+        set_ids_array.fromstring(set_ids)
+        return cls(ordinals_array,
+                   [intern(pid) for pid in pids.split('\n')] if pids else [],
+                   names, sets, set_ids_array)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __iter__(self):
+        for position in xrange(len(self.pids)):
+            yield self.entry(position)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.entry(position) for position
+                    in xrange(*item.indices(len(self.pids)))]
+        return self.entry(item)
+
+    def entry(self, position):
+        return Entry(self.ordinals[position], self.pids[position],
+                     self._named_sets[self.set_ids[position]])
+
+    def find(self, ordinal, pid):
+        ordinals = self.ordinals
+        low, high = 0, len(ordinals)
+        while low < high:
+            middle = (low + high) // 2
+            if ordinals[middle] > ordinal:
+                low = middle + 1
+            else:
+                high = middle
+        while low < len(ordinals) and ordinals[low] == ordinal:
+            if self.pids[low] == pid:
+                return self.entry(low)
+            low += 1
+        return None
+
+
+class IndexState(object):
+    __slots__ = ('entries', 'files', 'posts', 'mtime', 'shards',
+                 'category_positions', 'archive_ranges', 'categories',
+                 'archive')
+
+    def __init__(self, entries, files, posts, mtime, shards):
+        self.entries = entries
+        self.files = files
+        self.posts = posts
+        self.mtime = mtime
+        self.shards = shards
+        members = [list() for _ in entries.sets]
+        for position, set_id in enumerate(entries.set_ids):
+            members[set_id].append(position)
+        by_category = dict()
+        for ids, positions in zip(entries.sets, members):
+            for category_id in ids:
+                by_category.setdefault(entries.names[category_id],
+                                       []).extend(positions)
+        self.category_positions = dict(
+            (name, array('i', sorted(positions)))
+            for name, positions in by_category.iteritems())
+        by_month, position, count = dict(), 0, len(entries)
+        while position < count:
+            date = datetime.fromordinal(entries.ordinals[position])
+            first = date.replace(day=1).toordinal()
+            end = position + 1
+            while end < count and entries.ordinals[end] >= first:
+                end += 1
+            by_month['%04d-%02d' % (date.year, date.month)] = \
+                [position, end]
+            position = end
+        self.archive_ranges = by_month
+        self.categories = sorted(self.category_positions)
+        self.archive = sorted(by_month, reverse=True)
+
+    def dump(self):
+        fields = dict((name, getattr(self, name)) for name in self.__slots__)
+        fields['entries'] = self.entries.dump()
+        fields['category_positions'] = dict(
+            (name, positions.tostring())
+            for name, positions in self.category_positions.iteritems())
+        return fields
+
+    @classmethod
+    def restore(cls, fields):
+        state = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(state, name, fields[name])
+        state.entries = EntryTable.restore(fields['entries'])
+        state.category_positions = dict()
+        for name, data in fields['category_positions'].iteritems():
+            positions = array('i')
+            positions.fromstring(data)
+            state.category_positions[name] = positions
+        return state
+
+
+class Router(object):
+    _converters = {'str': ('[^/]+', unquote_plus),
+                   'int': ('\d+', int),
+                   'month': ('\d{4}-\d{2}', str),
+                   'date': ('\d{4}-\d{2}-\d{2}', str),
+                   'ids': ('\d+(?:-\d+)*', str)}
+    _re_param = re.compile('<(?:(\w+):)?(\w+)>')
+
+    def __init__(self):
+        self._routes = dict()
+        self._compiled = dict()
+
+    def add(self, method, pattern, handler, **defaults):
+        routes = self._routes.setdefault(method.upper(), [])
+        group = 'r%d' % len(routes)
+        params = list()
+        regex, pos = [], 0
+        for matched in self._re_param.finditer(pattern):
+            kind, name = matched.group(1) or 'str', matched.group(2)
+            regex.append(re.escape(pattern[pos:matched.start()]))
+            regex.append('(?P<%s_%s>%s)' % (group, name,
+                                            self._converters[kind][0]))
+            params.append((group + '_' + name, name,
+                           self._converters[kind][1]))
+            pos = matched.end()
+        regex.append(re.escape(pattern[pos:].rstrip('/')))
+        routes.append((group, pattern, '(?P<%s>%s)' % (group, ''.join(regex)),
+                       handler, params, defaults))
+        self._compiled.pop(method.upper(), None)
+
+    def _compile(self, method):
+        routes = self._routes.get(method, [])
+        regex = re.compile('^(?:%s)/?$' % '|'.join(route[2]
+                                                    for route in routes))
+        table = dict((route[0], route) for route in routes)
+        self._compiled[method] = regex, table
+        return regex, table
+
+    def match(self, method, path):
+        if method not in self._routes:
+            return None, None, None
+        regex, table = self._compiled.get(method) or self._compile(method)
+        matched = regex.match(path)
+        if not matched:
+            return None, None, None
+        _, pattern, _, handler, params, defaults = table[matched.lastgroup]
+        kwargs = dict(defaults)
+        for group, name, convert in params:
+            kwargs[name] = convert(matched.group(group))
+        return handler, kwargs, pattern
+
+
+class CommentStore(object):
+    _magic = 'TKCS'
+    _header = struct.Struct('<4sQQ')
+
+    def __init__(self, comments_dir, file_name_sep, nesting, compact_bytes,
+                 logger, sharded=False):
+        self.comments_dir = comments_dir
+        self.file_name_sep = file_name_sep
+        self.sharded = sharded
+        self.nesting = nesting
+        self.compact_bytes = compact_bytes
+        self._logger = logger
+        self._compacting = set()
+        self._compacting_lock = threading.Lock()
+
+    def path(self, archive, pid):
+        file_name = pid + self.file_name_sep + archive + '.comments'
+        if self.sharded:
+            return os.path.join(self.comments_dir, archive[:4], archive[5:7],
+                                file_name)
+        return os.path.join(self.comments_dir, file_name)
+
+    def mtime(self, archive, pid):
+        path = self.path(archive, pid)
+        mtime = 0
+        for file_path in (path, path + '.log'):
+            try:
+                mtime = max(mtime, os.path.getmtime(file_path))
+            except OSError:
+                pass
+        return mtime
+
+    def get_comment(self, comments, comments_num):
+        comment = None
+        level = 0
+        while comments_num:
+            index = comments_num[0]
+            if level == self.nesting:
+                return comment
+            if index < len(comments):
+                comment = comments[index]
+                comments, comments_num = comment[4], comments_num[1:]
+            else:
+                comment, comments_num = None, None
+            level += 1
+        return comment
+
+    def apply(self, comments, record):
+        if record[0] == 'add':
+            parent_comment = self.get_comment(comments, record[1])
+            replies = parent_comment[4] if parent_comment else comments
+            replies.append(record[2] + ([],))
+            replies.sort(key=lambda c: c[0], reverse=True)
+            return True
+        ids = list(record[1])
+        id_to_delete = ids.pop()
+        parent_comment = self.get_comment(comments, ids)
+        replies = comments if not ids else \
+            (parent_comment[4] if parent_comment else [])
+        if id_to_delete < len(replies):
+            del replies[id_to_delete]
+            return True
+        return False
+
+    def _count(self, comment):
+        return 1 + sum(self._count(reply) for reply in comment[4])
+
+    def _read_table(self, snapshot):
+        if snapshot is None:
+            return 0, list()
+        head = snapshot.read(self._header.size)
+        if len(head) == self._header.size and head.startswith(self._magic):
+            _, generation, table_offset = self._header.unpack(head)
+            snapshot.seek(table_offset)
+            return generation, [[date, count, None, offset] for
+                                date, count, offset in load_pickle(snapshot)]
+        snapshot.seek(0)
+        return 0, [[comment[0], self._count(comment), comment, None]
+                   for comment in load_pickle(snapshot)]
+
+    def _materialize(self, item, snapshot):
+        if item[2] is None:
+            snapshot.seek(item[3])
+            item[2] = load_pickle(snapshot)
+        return item[2]
+
+    def _apply_item(self, items, record, snapshot):
+        ids = list(record[1])
+        if record[0] == 'add':
+            if ids and ids[0] < len(items):
+                item = items[ids[0]]
+                thread = [self._materialize(item, snapshot)]
+                if self.get_comment(thread, [0] + ids[1:]) is not None:
+                    self.apply(thread, ('add', [0] + ids[1:], record[2]))
+                    item[1] += 1
+                    return True
+            comment = record[2] + ([],)
+            items.append([comment[0], 1, comment, None])
+            items.sort(key=lambda i: i[0], reverse=True)
+            return True
+        if ids[0] >= len(items):
+            return False
+        if len(ids) == 1:
+            del items[ids[0]]
+            return True
+        item = items[ids[0]]
+        thread = [self._materialize(item, snapshot)]
+        if self.apply(thread, ('delete', [0] + ids[1:])):
+            item[1] = self._count(thread[0])
+            return True
+        return False
+
+    def _snapshot_generation(self, path):
+        try:
+            with open_for_reading(path) as f:
+                head = f.read(self._header.size)
+        except IOError:
+            return 0
+        if len(head) == self._header.size and head.startswith(self._magic):
+            return self._header.unpack(head)[1]
+        return 0
+
+    def _log_generation(self, path):
+        try:
+            with open_for_reading(path + '.log') as f:
+                record = load_pickle(f)
+        except (IOError, EOFError):
+            return None
+        return record[1] if record[0] == 'generation' else 0
+
+    def _replay(self, items, log, generation, snapshot):
+        first = True
+        while True:
+            try:
+                record = load_pickle(log)
+            except EOFError:
+                break
+            except Exception:
+                self._logger.warn('comment log [%s] has a damaged record',
+                                  log.name, exc_info=1)
+                break
+            if first:
+                first = False
+                log_generation = record[1] if record[0] == 'generation' \
+                    else 0
+                if log_generation != generation:
+                    self._logger.debug('comment log [%s] was already '
+                                       'compacted into its snapshot',
+                                       log.name)
+                    break
+                if record[0] == 'generation':
+                    continue
+            self._apply_item(items, record, snapshot)
+
+    def _read(self, path, log, start=0, end=None):
+        try:
+            snapshot = open_for_reading(path)
+        except IOError:
+            snapshot = None
+        try:
+            generation, items = self._read_table(snapshot)
+            if log is not None:
+                self._replay(items, log, generation, snapshot)
+            comments = [self._materialize(item, snapshot)
+                        for item in items[start:end]]
+            return generation, comments, len(items), \
+                sum(item[1] for item in items)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+    def load_page(self, archive, pid, start=0, end=None):
+        path = self.path(archive, pid)
+        try:
+            log = open_for_reading(path + '.log')
+        except IOError:
+            return self._read(path, None, start, end)[1:]
+        with log:
+            fcntl.flock(log, fcntl.LOCK_SH)
+            return self._read(path, log, start, end)[1:]
+
+    def load(self, archive, pid):
+        return self.load_page(archive, pid)[0]
+
+    def append(self, archive, pid, record):
+        path = self.path(archive, pid)
+        comments = None
+        if record[0] != 'add' and not os.path.exists(path) and \
+                not os.path.exists(path + '.log'):
+            return None
+        if self.sharded and not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        with open(path + '.log', 'ab') as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            generation = self._snapshot_generation(path)
+            if self._log_generation(path) != generation:
+                log.truncate(0)
+                log.write(cPickle.dumps(('generation', generation),
+                                        cPickle.HIGHEST_PROTOCOL))
+                log.flush()
+            if record[0] != 'add':
+                with open_for_reading(path + '.log') as f:
+                    comments = self._read(path, f)[1]
+                if not self.apply(comments, record):
+                    return None
+            log.write(cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL))
+            log.flush()
+            size = log.tell()
+        if size > self.compact_bytes:
+            self._compact_in_background(archive, pid)
+        return comments
+
+    def _compact_in_background(self, archive, pid):
+        with self._compacting_lock:
+            if (archive, pid) in self._compacting:
+                return
+            self._compacting.add((archive, pid))
+        thread = threading.Thread(target=self._compact_quietly,
+                                  args=(archive, pid))
+        thread.daemon = True
+        thread.start()
+
+    def _compact_quietly(self, archive, pid):
+        try:
+            self.compact(archive, pid)
+        except (IOError, OSError):
+            self._logger.error('IOError occurred while compacting comments '
+                               'of %s/%s', archive, pid, exc_info=1)
+        finally:
+            with self._compacting_lock:
+                self._compacting.discard((archive, pid))
+
+    def compact(self, archive, pid):
+        path = self.path(archive, pid)
+        with open(path + '.log', 'r+b') as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            generation, comments = self._read(path, log)[:2]
+            generation += 1
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with closing(os.fdopen(tmp_fd, 'wb')) as tmp_file:
+                    tmp_file.write(self._header.pack(self._magic, 0, 0))
+                    table = list()
+                    for comment in comments:
+                        table.append((comment[0], self._count(comment),
+                                      tmp_file.tell()))
+                        cPickle.dump(comment, tmp_file,
+                                     protocol=cPickle.HIGHEST_PROTOCOL)
+                    table_offset = tmp_file.tell()
+                    cPickle.dump(table, tmp_file,
+                                 protocol=cPickle.HIGHEST_PROTOCOL)
+                    tmp_file.seek(0)
+                    tmp_file.write(self._header.pack(self._magic, generation,
+                                                     table_offset))
+                os.rename(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            log.seek(0)
+            log.truncate()
+            log.write(cPickle.dumps(('generation', generation),
+                                    cPickle.HIGHEST_PROTOCOL))
+        self._logger.debug('comments of %s/%s were compacted', archive, pid)
+
+
+def encode_postings(ids):
+    buf, previous = bytearray(), 0
+    for doc_id in ids:
+        delta, previous = doc_id - previous, doc_id
+        while delta >= 0x80:
+            buf.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        buf.append(delta)
+    return str(buf)
+
+
+def decode_postings(data):
+    ids, value, shift, previous = [], 0, 0, 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += value
+            ids.append(previous)
+            value, shift = 0, 0
+    return ids
+
+
+class SearchIndex(object):
+    _format = 2
+    _re_tag = re.compile('<[^>]*>')
+    _re_word = re.compile('\w+', re.UNICODE)
+
+    def __init__(self):
+        self.docs = dict()
+        self.files = dict()
+        self.terms = dict()
+        self.doc_terms = dict()
+        self.next_id = 1
+
+    @classmethod
+    def load(cls, search_index_path):
+        search_index = cls()
+        if os.path.exists(search_index_path):
+            with open_for_reading(search_index_path) as f:
+                data = load_pickle(f)
+            if data.get('format') == cls._format:
+                search_index.docs = data['docs']
+                search_index.terms = data['terms']
+                search_index.doc_terms = data['doc_terms']
+                search_index.next_id = data['next_id']
+                search_index.files = dict((doc[0], doc_id) for doc_id, doc
+                                          in search_index.docs.iteritems())
+        return search_index
+
+    def copy(self):
+        search_index = SearchIndex()
+        search_index.docs = dict(self.docs)
+        search_index.files = dict(self.files)
+        search_index.terms = dict(self.terms)
+        search_index.doc_terms = dict(self.doc_terms)
+        search_index.next_id = self.next_id
+        return search_index
+
+    def dump(self):
+        return {'format': self._format, 'docs': self.docs,
+                'terms': self.terms, 'doc_terms': self.doc_terms,
+                'next_id': self.next_id}
+
+    @classmethod
+    def tokenize(cls, text):
+        text = cls._re_tag.sub(' ', text).decode('utf-8', 'replace').lower()
+        return set(word.encode('utf-8') for word in cls._re_word.findall(text)
+                   if len(word) <= 40)
+
+    def diff(self, index_files):
+        changed = [file_name for file_name, stat_info
+                   in index_files.iteritems()
+                   if file_name not in self.files or
+                   self.docs[self.files[file_name]][2] != stat_info]
+        removed = [file_name for file_name in self.files
+                   if file_name not in index_files]
+        return changed, removed
+
+    def update(self, docs, removed):
+        affected = dict()
+        for file_name in removed + [doc[0] for doc in docs
+                                    if doc[0] in self.files]:
+            doc_id = self.files.pop(file_name)
+            del self.docs[doc_id]
+            for term in self.doc_terms.pop(doc_id):
+                affected.setdefault(term, (set(), []))[0].add(doc_id)
+        for file_name, key, stat_info, terms in docs:
+            doc_id, self.next_id = self.next_id, self.next_id + 1
+            self.files[file_name] = doc_id
+            self.docs[doc_id] = (file_name, key, stat_info)
+            self.doc_terms[doc_id] = tuple(terms)
+            for term in terms:
+                affected.setdefault(term, (set(), []))[1].append(doc_id)
+        for term, (gone, added) in affected.iteritems():
+            ids = [other_id for other_id
+                   in decode_postings(self.terms.get(term, ''))
+                   if other_id not in gone] + added
+            if ids:
+                self.terms[term] = encode_postings(ids)
+            else:
+                self.terms.pop(term, None)
+
+    def search(self, query):
+        terms = self.tokenize(query)
+        if not terms:
+            return []
+        postings = [self.terms.get(term, '') for term in terms]
+        postings.sort(key=len)
+        found = set(decode_postings(postings[0]))
+        for data in postings[1:]:
+            if not found:
+                break
+            found.intersection_update(decode_postings(data))
+        return [self.docs[doc_id][1] for doc_id in found]
+
+
+_io_counts = threading.local()
+
+
+def _count_io(kind):
+    counts = getattr(_io_counts, 'counts', None)
+    if counts is not None:
+        counts[kind] = counts.get(kind, 0) + 1
+
+
+def open_for_reading(path):
+    _count_io('file_reads')
+    return open(path, 'rb')
+
+
+def load_pickle(f):
+    _count_io('pickle_loads')
+    return cPickle.load(f)
+
+
+def list_shards(root):
+    shards = dict()
+    try:
+        years = os.listdir(root)
+    except OSError:
+        return shards
+    for year in years:
+        if not re.match('\d{4}$', year):
+            continue
+        try:
+            months = os.listdir(os.path.join(root, year))
+        except OSError:
+            continue
+        for month in months:
+            if re.match('\d{2}$', month):
+                shard = os.path.join(year, month)
+                try:
+                    shards[shard] = os.path.getmtime(os.path.join(root, shard))
+                except OSError:
+                    pass
+    return shards
+
+
+class Metrics(object):
+    _buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1.0, 2.5)
+
+    def __init__(self, path, store_dir, flush_interval, logger):
+        self.path = path
+        self.store_dir = store_dir
+        self.flush_interval = flush_interval
+        self._logger = logger
+        self._caches = dict()
+        self._cache_base = dict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._totals = dict()
+        self._flushed_at = 0
+        if store_dir and not os.path.isdir(store_dir):
+            try:
+                os.makedirs(store_dir)
+            except OSError:
+                if not os.path.isdir(store_dir):
+                    raise
+
+    def register_cache(self, name, cache):
+        self._caches[name] = cache
+        self._cache_base[name] = (cache.hits, cache.misses)
+
+    def _store_path(self, pid):
+        return os.path.join(self.store_dir, '%d.metrics' % pid)
+
+    def _worker_totals(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid, self._totals = pid, dict()
+            if self.store_dir:
+                try:
+                    with open(self._store_path(pid), 'rb') as f:
+                        self._totals = cPickle.load(f)
+                except (IOError, EOFError, cPickle.UnpicklingError):
+                    pass
+            for name, cache in self._caches.iteritems():
+                self._cache_base[name] = (
+                    cache.hits - self._totals.get(('cache_hits', name), 0),
+                    cache.misses - self._totals.get(('cache_misses', name), 0))
+        return self._totals
+
+    def _snapshot(self):
+        totals = dict(self._worker_totals())
+        for name, cache in self._caches.iteritems():
+            hits, misses = self._cache_base[name]
+            totals[('cache_hits', name)] = cache.hits - hits
+            totals[('cache_misses', name)] = cache.misses - misses
+        return totals
+
+    def flush(self):
+        if not self.store_dir:
+            return
+        with self._lock:
+            totals = self._snapshot()
+            self._flushed_at = time.time()
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.store_dir)
+        try:
+            with closing(os.fdopen(tmp_fd, 'wb')) as tmp_file:
+                cPickle.dump(totals, tmp_file,
+                             protocol=cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._store_path(os.getpid()))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def record(self, route, method, status, elapsed, sent, counts):
+        with self._lock:
+            totals = self._worker_totals()
+            for key, value in ((('requests', route, method, status), 1),
+                               (('duration_sum', route), elapsed),
+                               (('duration_count', route), 1),
+                               (('bytes', route), sent),
+                               (('file_reads', route),
+                                counts.get('file_reads', 0)),
+                               (('pickle_loads', route),
+                                counts.get('pickle_loads', 0))):
+                totals[key] = totals.get(key, 0) + value
+            for bucket in self._buckets:
+                if elapsed <= bucket:
+                    key = ('duration_bucket', route, bucket)
+                    totals[key] = totals.get(key, 0) + 1
+            due = time.time() - self._flushed_at >= self.flush_interval
+        if due:
+            try:
+                self.flush()
+            except (IOError, OSError):
+                self._logger.error('IOError occurred while storing metrics',
+                                   exc_info=1)
+
+    def collect(self):
+        if not self.store_dir:
+            with self._lock:
+                return self._snapshot()
+        self.flush()
+        totals = dict()
+        for file_name in os.listdir(self.store_dir):
+            if not file_name.endswith('.metrics'):
+                continue
+            try:
+                with open(os.path.join(self.store_dir, file_name), 'rb') as f:
+                    worker_totals = cPickle.load(f)
+            except (IOError, EOFError, cPickle.UnpicklingError):
+                continue
+            for key, value in worker_totals.iteritems():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    @staticmethod
+    def _labels(**labels):
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', '\\\\').
+                         replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in sorted(labels.iteritems()))
+
+    def expose(self):
+        totals = self.collect()
+        by_kind = dict()
+        for key, value in totals.iteritems():
+            by_kind.setdefault(key[0], []).append((key[1:], value))
+        lines = list()
+
+        def family(name, kind, help_text):
+            lines.append('# HELP tohtkiri_%s %s' % (name, help_text))
+            lines.append('# TYPE tohtkiri_%s %s' % (name, kind))
+
+        family('requests_total', 'counter', 'Requests by route and status.')
+        for (route, method, status), value in sorted(
+                by_kind.get('requests', [])):
+            lines.append('tohtkiri_requests_total%s %d' % (
+                self._labels(route=route, method=method, status=status),
+                value))
+        family('request_duration_seconds', 'histogram',
+               'Time spent rendering and sending responses.')
+        buckets = dict(by_kind.get('duration_bucket', []))
+        sums = dict(by_kind.get('duration_sum', []))
+        for (route,), count in sorted(by_kind.get('duration_count', [])):
+            for bucket in self._buckets:
+                lines.append('tohtkiri_request_duration_seconds_bucket%s %d' %
+                             (self._labels(route=route, le=repr(bucket)),
+                              buckets.get((route, bucket), 0)))
+            lines.append('tohtkiri_request_duration_seconds_bucket%s %d' %
+                         (self._labels(route=route, le='+Inf'), count))
+            lines.append('tohtkiri_request_duration_seconds_sum%s %f' %
+                         (self._labels(route=route), sums[(route,)]))
+            lines.append('tohtkiri_request_duration_seconds_count%s %d' %
+                         (self._labels(route=route), count))
+        for kind, name, help_text in (
+                ('bytes', 'response_bytes_total', 'Response bytes sent.'),
+                ('file_reads', 'file_reads_total',
+                 'Files opened for reading while serving requests.'),
+                ('pickle_loads', 'pickle_loads_total',
+                 'Pickles loaded while serving requests.')):
+            family(name, 'counter', help_text)
+            for (route,), value in sorted(by_kind.get(kind, [])):
+                lines.append('tohtkiri_%s%s %d' % (
+                    name, self._labels(route=route), value))
+        for kind, name, help_text in (
+                ('cache_hits', 'cache_hits_total', 'Cache lookups that hit.'),
+                ('cache_misses', 'cache_misses_total',
+                 'Cache lookups that missed.')):
+            family(name, 'counter', help_text)
+            for (cache,), value in sorted(by_kind.get(kind, [])):
+                lines.append('tohtkiri_%s%s %d' % (
+                    name, self._labels(cache=cache), value))
+        family('cache_hit_ratio', 'gauge', 'Share of cache lookups that hit.')
+        misses = dict(by_kind.get('cache_misses', []))
+        for (cache,), hits in sorted(by_kind.get('cache_hits', [])):
+            lookups = hits + misses.get((cache,), 0)
+            lines.append('tohtkiri_cache_hit_ratio%s %f' % (
+                self._labels(cache=cache),
+                float(hits) / lookups if lookups else 0))
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, environ, start_response, app):
+        if environ.get('PATH_INFO') == self.path:
+            body = self.expose()
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                ('Content-Length', str(len(body)))])
+            return [body]
+        return self._observe(environ, start_response, app)
+
+    def _observe(self, environ, start_response, app):
+        statuses = list()
+
+        def capture(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        counts = dict()
+        _io_counts.counts = counts
+        started, sent = time.time(), 0
+        result = None
+        try:
+            result = app(environ, capture)
+            if isinstance(result, basestring):
+                result = [result]
+            for chunk in result:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            _io_counts.counts = None
+            if hasattr(result, 'close'):
+                result.close()
+            self.record(environ.get('tohtkiri.route') or 'unmatched',
+                        environ.get('REQUEST_METHOD', 'GET').upper(),
+                        statuses[-1][0:3] if statuses else '500',
+                        time.time() - started, sent, counts)
+
+
 class Blog(object):
     _statuses = {404: '404 Not Found', 200: '200 OK', 303: '303 See Other',
-                 400: '400 Bad Request'}
+                 400: '400 Bad Request', 304: '304 Not Modified'}
 
     _tpl_header = Template('<!DOCTYPE html>\n'
                            '<html xmlns="http://www.w3.org/1999/html">\n'
@@ -66,6 +1160,10 @@ class Blog(object):
     _tpl_view_full = Template('<a href="#">View full post &rarr;</a>')
     _tpl_entries_end = '\t\t</section>\n'
 
+    _tpl_search_title = Template('\t\t\t<header><h2>Search results for '
+                                 '&laquo;${query}&raquo;: ${count}</h2>'
+                                 '</header>\n')
+
     _tpl_aside = Template('\t\t<aside>\n'
                           '\t\t\t<nav><h2>Categories</h2>\n'
                           '\t\t\t\t<ul>\n'
@@ -82,6 +1180,12 @@ class Blog(object):
     _tpl_aside_entry = Template('\t\t\t\t\t<li><a href="${link}">${title}</a>'
                                 '</li>\n')
 
+    _tpl_aside_year = Template('\t\t\t\t\t<li><details${open}>'
+                               '<summary>${year}</summary>\n'
+                               '\t\t\t\t\t<ul>\n'
+                               '${months}'
+                               '\t\t\t\t\t</ul></details></li>\n')
+
     _tpl_footer = Template('\t</main>\n'
                            '\t<footer>\n'
                            '\t\t<nav>${links}</nav>\n'
@@ -120,6 +1224,7 @@ class Blog(object):
                          '\t\t\t\t</div>\n'
                          '\t\t\t\t</footer>\n'
                          '\t\t\t</article>\n')
+    _tpl_post_head, _tpl_post_tail = _tpl_post.split('comments')
 
     _tpl_comment = Template('\t\t\t\t<div class="comment">\n'
                             '\t\t\t\t<div class="comment_body">\n'
@@ -154,6 +1259,10 @@ class Blog(object):
                             '\t\t\t\t<div class="reply_comments">${comments}'
                             '</div>\n'
                             '\t\t\t\t</div>\n')
+    _tpl_comment_head, _tpl_comment_tail = _tpl_comment.split('comments')
+
+    _tpl_collapsed_comments = Template('<details class="collapsed_comments">'
+                                       '<summary>${count}</summary>\n')
 
     _tpl_delete_comment = Template('\t\t\t<form method="post" '
                                    'action="${url}/${ids}">\n'
@@ -189,16 +1298,56 @@ class Blog(object):
 
     _tpl_feed_end = '</feed>'
 
-    def __init__(self):
+    _index_format = 4
+    _snapshot_format = 2
+
+    _compressors = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+    router = Router()
+    router.add('GET', '/', 'cached_list')
+    router.add('GET', '/page/<int:page>', 'cached_list')
+    router.add('GET', '/category/<category>', 'cached_list')
+    router.add('GET', '/category/<category>/page/<int:page>', 'cached_list')
+    router.add('GET', '/archive/<month:archive>', 'cached_list')
+    router.add('GET', '/archive/<month:archive>/page/<int:page>',
+               'cached_list')
+    router.add('GET', '/post/<date:archive>/<pid>', 'cached_post')
+    router.add('GET', '/post/<date:archive>/<pid>/admin', 'cached_post',
+               admin=True)
+    router.add('GET', '/post/<date:archive>/<pid>/comments/page/<int:page>',
+               'cached_post')
+    router.add('GET', '/delete/<date:archive>/<pid>/<ids:ids_str>',
+               'get_delete_comment')
+    router.add('GET', '/search', 'get_search')
+    router.add('GET', '/rss', 'cached_rss')
+    router.add('GET', '/rss/<category>', 'cached_rss')
+    router.add('POST', '/post/<date:archive>/<pid>', 'post_comment')
+    router.add('POST', '/delete/<date:archive>/<pid>/<ids:ids_str>',
+               'post_delete_comment')
+
+    index = property(lambda self: self.state.entries)
+    categories = property(lambda self: self.state.categories)
+    archive = property(lambda self: self.state.archive)
+    _index_files = property(lambda self: self.state.files)
+    _index_posts = property(lambda self: self.state.posts)
+    _index_mtime = property(lambda self: self.state.mtime)
+    _index_shards = property(lambda self: self.state.shards)
+    _category_positions = property(
+        lambda self: self.state.category_positions)
+    _archive_ranges = property(lambda self: self.state.archive_ranges)
+
+    def __init__(self, conf_path=None, **overrides):
         self._encoding = 'UTF-8'
         script_path, _ = os.path.split(os.path.realpath(__file__))
         conf = dict()
-        conf_path = os.path.join(script_path, 'index.conf')
+        conf_path = conf_path or os.path.join(script_path, 'index.conf')
+        self.conf_path = conf_path
         try:
             execfile(conf_path, conf)
         except IOError:
             print 'I wasn\'t able to read configuration file [%s]. Default ' \
                   'settings will be used' % conf_path
+        conf.update(overrides)
         logging.basicConfig(level=logging.DEBUG)
         self._logger = logging.getLogger(__name__)
         self.entries_dir = conf.get('entries_path', os.path.join(script_path,
@@ -221,11 +1370,101 @@ class Blog(object):
             self.comments_nesting = int(conf.get('comments_nesting', 7))
         except ValueError:
             self.comments_nesting = 7
-        self.index = self._try_main_index(os.path.join(self.indices_dir,
-                                                       'main.index'))
+        try:
+            self.comments_per_page = int(conf.get('comments_per_page', 50))
+        except ValueError:
+            self.comments_per_page = 50
+        try:
+            self.index_refresh_interval = \
+                float(conf.get('index_refresh_interval', 5))
+        except ValueError:
+            self.index_refresh_interval = 5
+        try:
+            self._posts = LRUCache(int(conf.get('post_cache_size', 256)),
+                                   int(conf.get('post_cache_bytes',
+                                                8 * 1024 * 1024)))
+        except ValueError:
+            self._posts = LRUCache(256, 8 * 1024 * 1024)
+        try:
+            self._responses = \
+                LRUCache(int(conf.get('response_cache_size', 512)),
+                         int(conf.get('response_cache_bytes',
+                                      32 * 1024 * 1024)))
+        except ValueError:
+            self._responses = LRUCache(512, 32 * 1024 * 1024)
+        try:
+            self.response_cache_max_age = \
+                float(conf.get('response_cache_max_age', 0))
+        except ValueError:
+            self.response_cache_max_age = 0
+        try:
+            self.compression_level = int(conf.get('compression_level', 6))
+        except ValueError:
+            self.compression_level = 6
+        self.compression_encodings = [
+            encoding for encoding in conf.get('compression_encodings',
+                                              ['gzip'])
+            if encoding in self._compressors]
+        try:
+            compact_bytes = int(conf.get('comments_compact_bytes', 64 * 1024))
+        except ValueError:
+            compact_bytes = 64 * 1024
+        self.sharded_layout = bool(conf.get('sharded_layout', False))
+        self._comment_store = CommentStore(self.comments_dir,
+                                           self.file_name_sep,
+                                           self.comments_nesting,
+                                           compact_bytes, self._logger,
+                                           self.sharded_layout)
+        try:
+            self.aside_archive_limit = int(conf.get('aside_archive_limit', 0))
+        except ValueError:
+            self.aside_archive_limit = 0
+        self.aside_archive_by_year = bool(conf.get('aside_archive_by_year',
+                                                   False))
+        self._asides = LRUCache(16)
+        self.metrics = None
+        if conf.get('metrics_path'):
+            try:
+                flush_interval = float(conf.get('metrics_flush_interval', 1))
+            except ValueError:
+                flush_interval = 1
+            self.metrics = Metrics(conf['metrics_path'],
+                                   conf.get('metrics_dir',
+                                            os.path.join(self.indices_dir,
+                                                         'metrics')),
+                                   flush_interval, self._logger)
+            for name, cache in (('posts', self._posts),
+                                ('responses', self._responses),
+                                ('asides', self._asides)):
+                self.metrics.register_cache(name, cache)
+        self._state = None
+        self._state_lock = threading.RLock()
+        self.refresh_entries = True
+        self._index_checked_at = time.time()
+        self._comments_index_mtime = None
+        self._comment_counts = dict()
+        self._search = None
+        self._chunk_pool = None
+        self.search_enabled = bool(conf.get('search_enabled', True))
+        self.lazy_index = bool(conf.get('lazy_index', False))
+        self.warm_start = bool(conf.get('warm_start', False))
+        self.watch_index = bool(conf.get('watch_index', False))
+        try:
+            self.watch_debounce = float(conf.get('watch_debounce', 0.2))
+        except ValueError:
+            self.watch_debounce = 0.2
+        try:
+            self.watch_poll_interval = \
+                float(conf.get('watch_poll_interval', 1))
+        except ValueError:
+            self.watch_poll_interval = 1
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+        if not self.lazy_index:
+            self._load_state()
+        if self.watch_index:
+            self._start_watcher()
         self.author = conf.get('author', 'anonymous')
-        self.categories = self.list_categories()
-        self.archive = self.list_archive()
         password = conf.get('password')
         if password:
             m = hashlib.md5()
@@ -250,41 +1489,329 @@ class Blog(object):
                 os.remove(tmp_path)
 
     def _try_main_index(self, main_index_path):
-        if not os.path.exists(main_index_path):
-            return self._create_main_index(main_index_path)
-        else:
-            with open(main_index_path, 'rb') as f:
-                return cPickle.load(f)
+        if os.path.exists(main_index_path):
+            with open_for_reading(main_index_path) as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                data = load_pickle(f)
+            if isinstance(data, dict) and \
+                    data.get('format') == self._index_format and \
+                    data.get('sharded') == self.sharded_layout:
+                return EntryTable.restore(data['entries']), data['files'], \
+                    data['posts'], mtime, data['shards']
+            self._logger.info('main index [%s] has an outdated format or '
+                              'layout and will be rebuilt', main_index_path)
+        return self._create_main_index(main_index_path)
 
     def _create_main_index(self, main_index_path):
-        entries = list()
+        shards = list_shards(self.entries_dir) if self.sharded_layout \
+            else dict()
+        files = self._scan_entries(shards)
+        entries, posts = list(), dict()
+        for chunk in self._map_chunks('_read_all_metadata', sorted(files)):
+            posts.update(chunk)
+        for file_name, (date, pid, _, _) in files.items():
+            if file_name not in posts:
+                del files[file_name]
+                continue
+            entries.append(Entry(date.toordinal(), pid,
+                                 self._categories_set(posts[file_name])))
+        self._comment_counts = self._create_comments_index(
+            os.path.join(self.indices_dir, 'comments.index'))
+        return self._store_main_index(main_index_path, entries, files, posts,
+                                      shards)
+
+    def _store_main_index(self, main_index_path, entries, files, posts,
+                          shards):
+        entries = EntryTable.pack(entries)
+        files = dict((file_name, info[2:]) for file_name, info
+                     in files.iteritems())
+        self._serialize_object({'format': self._index_format,
+                                'sharded': self.sharded_layout,
+                                'entries': entries.dump(),
+                                'files': files,
+                                'posts': posts,
+                                'shards': shards}, main_index_path,
+                               force=True)
+        return entries, files, posts, os.path.getmtime(main_index_path), \
+            shards
+
+    @property
+    def state(self):
+        if self._state is None:
+            with self._state_lock:
+                if self._state is None:
+                    self._load_state()
+        return self._state
+
+    def _load_state(self):
+        main_index_path = os.path.join(self.indices_dir, 'main.index')
+        if not self.warm_start or \
+                not self._try_warm_start(main_index_path):
+            self._apply_index(*self._try_main_index(main_index_path))
+        self._comment_counts = self._try_comments_index(
+            os.path.join(self.indices_dir, 'comments.index'))
+
+    def _try_warm_start(self, main_index_path):
+        snapshot_path = os.path.join(self.indices_dir, 'warm.snapshot')
+        try:
+            with open_for_reading(snapshot_path) as f:
+                data = load_pickle(f)
+            if data.get('format') != self._snapshot_format or \
+                    data.get('index_format') != self._index_format:
+                return False
+            state = IndexState.restore(data['state'])
+            if state.mtime != os.path.getmtime(main_index_path):
+                return False
+        except (IOError, OSError, EOFError, KeyError, AttributeError,
+                cPickle.UnpicklingError):
+            return False
+        self._state = state
+        self._logger.debug('index was restored from warm-start snapshot '
+                           '[%s]', snapshot_path)
+        return True
+
+    def _store_warm_start(self):
+        self._serialize_object({'format': self._snapshot_format,
+                                'index_format': self._index_format,
+                                'state': self._state.dump()},
+                               os.path.join(self.indices_dir,
+                                            'warm.snapshot'), force=True)
+
+    def _scan_entries(self, shards=None):
+        files = dict()
         re_file_name = re.compile('^(.+)' + self.file_name_sep +
                                   '(\d{4}-\d{2}-\d{2})\.txt$')
-        for file_name in os.listdir(self.entries_dir):
-            if os.path.isfile(os.path.join(self.entries_dir, file_name)):
-                matched = re_file_name.match(file_name)
-                if matched:
-                    try:
-                        date = datetime.strptime(matched.group(2), '%Y-%m-%d')
-                        entries.append((date, matched.group(1),
-                                        self._read_categories(file_name)))
-                    except ValueError:
-                        continue
-        entries.sort(reverse=True, key=lambda entry: (entry[0], entry[1]))
-        self._serialize_object(entries, main_index_path)
+        if not self.sharded_layout:
+            shards = ['']
+        elif shards is None:
+            shards = list_shards(self.entries_dir)
+        for shard in shards:
+            try:
+                names = os.listdir(os.path.join(self.entries_dir, shard))
+            except OSError:
+                continue
+            for name in names:
+                matched = re_file_name.match(name)
+                if not matched:
+                    continue
+                file_name = os.path.join(shard, name)
+                try:
+                    st = os.stat(os.path.join(self.entries_dir, file_name))
+                    date = datetime.strptime(matched.group(2), '%Y-%m-%d')
+                except (OSError, ValueError):
+                    continue
+                if stat.S_ISREG(st.st_mode) and file_name == \
+                        self.build_file_name(Entry(date.toordinal(),
+                                                   matched.group(1), ())):
+                    files[file_name] = (date, matched.group(1),
+                                        st.st_mtime, st.st_size)
+        return files
+
+    def refresh_index(self, rescan=()):
+        main_index_path = os.path.join(self.indices_dir, 'main.index')
+        if not os.path.exists(main_index_path):
+            self._apply_index(*self._create_main_index(main_index_path))
+            return True
+        shards = dict()
+        if self.sharded_layout:
+            shards = list_shards(self.entries_dir)
+            scope = set(rescan)
+            scope.update(shard for shard, mtime in shards.iteritems()
+                         if self._index_shards.get(shard) != mtime)
+            scope.update(shard for shard in self._index_shards
+                         if shard not in shards)
+            files = dict((file_name, (None, None) + info)
+                         for file_name, info in self._index_files.iteritems()
+                         if os.path.dirname(file_name) not in scope)
+            files.update(self._scan_entries(scope))
+        else:
+            files = self._scan_entries()
+        changed = [file_name for file_name, (_, _, mtime, size)
+                   in files.iteritems()
+                   if self._index_files.get(file_name) != (mtime, size)]
+        removed = [file_name for file_name in self._index_files
+                   if file_name not in files]
+        if not changed and not removed and shards == self._index_shards:
+            return False
+        entries = dict((self.build_file_name(entry), entry)
+                       for entry in self.index)
+        posts = dict(self._index_posts)
+        for file_name in removed:
+            entries.pop(file_name, None)
+            posts.pop(file_name, None)
+        for file_name in changed:
+            date, pid, _, _ = files[file_name]
+            try:
+                posts[file_name] = self._read_metadata(file_name)
+            except IOError:
+                entries.pop(file_name, None)
+                posts.pop(file_name, None)
+                del files[file_name]
+                continue
+            entries[file_name] = Entry(date.toordinal(), pid,
+                                       self._categories_set(posts[file_name]))
+        self._logger.debug('main index was refreshed: %d added or changed, '
+                           '%d removed', len(changed), len(removed))
+        self._apply_index(*self._store_main_index(main_index_path,
+                                                  entries.values(), files,
+                                                  posts, shards))
+        return True
+
+    def _apply_index(self, entries, files, posts, mtime, shards):
+        self._state = IndexState(entries, files, posts, mtime, shards)
+        self._asides.clear()
+        self._responses.clear()
+        if self.warm_start:
+            self._store_warm_start()
+        if self._search is not None or not self.lazy_index:
+            self._sync_search()
+
+    def _sync_search(self):
+        if not self.search_enabled:
+            return
+        search = self._search
+        if search is None:
+            search = SearchIndex.load(os.path.join(self.indices_dir,
+                                                   'search.index'))
+        changed, removed = search.diff(self._index_files)
+        if not changed and not removed:
+            self._search = search
+            return
+        entries = dict((self.build_file_name(entry), entry)
+                       for entry in self.index) if changed else dict()
+        jobs = [(file_name, entries[file_name].ordinal,
+                 entries[file_name].pid, self._index_files[file_name])
+                for file_name in changed if file_name in entries]
+        docs = list()
+        for chunk in self._map_chunks('_search_docs', jobs):
+            docs.extend(chunk)
+        if search is self._search:
+            search = search.copy()
+        search.update(docs, removed)
+        self._search = search
+        self._serialize_object(search.dump(),
+                               os.path.join(self.indices_dir, 'search.index'),
+                               force=True)
+        self._logger.debug('search index was updated: %d documents indexed, '
+                           '%d removed', len(docs), len(removed))
+
+    def _search_docs(self, jobs):
+        docs = list()
+        for file_name, ordinal, pid, stat_info in jobs:
+            try:
+                post = self._parse_post(Entry(ordinal, pid, ()), file_name)
+            except IOError:
+                continue
+            docs.append((file_name, (ordinal, pid), stat_info,
+                         SearchIndex.tokenize(" ".join(
+                             [post.get('title', ''),
+                              post.get('preview', ''),
+                              post.get('full', '')]))))
+        return docs
+
+    def _read_all_metadata(self, file_names):
+        posts = dict()
+        for file_name in file_names:
+            try:
+                posts[file_name] = self._read_metadata(file_name)
+            except IOError:
+                pass
+        return posts
+
+    def _map_chunks(self, method, items):
+        if self._chunk_pool is None:
+            return [getattr(self, method)(items)]
+        return self._chunk_pool.map(method, items)
+
+    def search(self, query):
+        if not self.search_enabled:
+            return []
+        search = self._search
+        if search is None:
+            with self._state_lock:
+                self._sync_search()
+            search = self._search
+        table = self.state.entries
+        entries = [table.find(ordinal, pid)
+                   for ordinal, pid in search.search(query)]
+        entries = [entry for entry in entries if entry]
+        entries.sort(reverse=True, key=lambda entry: (entry.ordinal,
+                                                      entry.pid))
         return entries
 
-    def _read_categories(self, file_name):
-        re_categories = re.compile('^categories:([^,]+)(?:,([^,]+))*$')
-        categories = set()
-        with open(os.path.join(self.entries_dir, file_name), mode='r') as f:
-            for line in f:
-                matched = re_categories.match(line)
-                if matched:
-                    for category in matched.groups():
-                        categories.add(category.strip())
-                    break
-        return categories
+    def _try_comments_index(self, comments_index_path):
+        if not os.path.exists(comments_index_path):
+            return self._create_comments_index(comments_index_path)
+        with open_for_reading(comments_index_path) as f:
+            self._comments_index_mtime = os.fstat(f.fileno()).st_mtime
+            return load_pickle(f)
+
+    def _create_comments_index(self, comments_index_path):
+        counts = dict()
+        re_file_name = re.compile('^(.+)' + self.file_name_sep +
+                                  '(\d{4}-\d{2}-\d{2})\.comments(?:\.log)?$')
+        shards = list_shards(self.comments_dir) if self.sharded_layout \
+            else ['']
+        for shard in shards:
+            try:
+                file_names = os.listdir(os.path.join(self.comments_dir, shard))
+            except OSError:
+                continue
+            for file_name in file_names:
+                matched = re_file_name.match(file_name)
+                if matched and (matched.group(2), matched.group(1)) \
+                        not in counts:
+                    count = self._comment_store.load_page(
+                        matched.group(2), matched.group(1), 0, 0)[2]
+                    if count:
+                        counts[(matched.group(2), matched.group(1))] = count
+        self._serialize_object(counts, comments_index_path, force=True)
+        self._comments_index_mtime = os.path.getmtime(comments_index_path)
+        return counts
+
+    def _reload_comments_index(self):
+        comments_index_path = os.path.join(self.indices_dir, 'comments.index')
+        try:
+            mtime = os.path.getmtime(comments_index_path)
+        except OSError:
+            mtime = None
+        if mtime != self._comments_index_mtime:
+            self._comment_counts = \
+                self._try_comments_index(comments_index_path)
+            self._responses.clear()
+
+    def _store_comment_count(self, archive, pid, count=None, delta=0):
+        comments_index_path = os.path.join(self.indices_dir, 'comments.index')
+        with open(comments_index_path + '.lock', 'ab') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._reload_comments_index()
+            counts = dict(self._comment_counts)
+            if count is None:
+                count = counts.get((archive, pid), 0) + delta
+            if count:
+                counts[(archive, pid)] = count
+            else:
+                counts.pop((archive, pid), None)
+            self._serialize_object(counts, comments_index_path, force=True)
+            self._comments_index_mtime = \
+                os.path.getmtime(comments_index_path)
+            self._comment_counts = counts
+
+    def comment_count(self, archive, pid):
+        return self._comment_counts.get((archive, pid), 0)
+
+    def _read_metadata(self, file_name):
+        scanned = self._scan_post(file_name, full=False)
+        meta = dict(scanned['texts'])
+        meta['categories'] = scanned['categories']
+        meta['has_full'] = 'full' in scanned['spans']
+        if 'title' in scanned:
+            meta['title'] = scanned['title']
+        return meta
+
+    @staticmethod
+    def _categories_set(meta):
+        return set(category for category in meta['categories'] if category)
 
     def status(self, rc, code, response):
         rc.response(self._statuses[code], [('Content-Type',
@@ -298,75 +1825,165 @@ class Blog(object):
     def list_file_names(self):
         main_index_path = os.path.join(self.indices_dir, 'main.index')
         if not os.path.exists(main_index_path):
-            self._create_main_index(main_index_path)
-        with open(main_index_path, 'rb') as f:
-            return cPickle.load(f)
+            return self._create_main_index(main_index_path)[0]
+        return self._try_main_index(main_index_path)[0]
 
     def filter_entries(self, category, archive):
+        state = self.state
         if category:
-            return [entry for entry in self.index if category in entry[2]]
+            return IndexView(state.entries,
+                             state.category_positions.get(category, []))
         elif archive:
-            archive = datetime.strptime(archive, '%Y-%m')
-            return [entry for entry in self.index if (archive.year,
-                                                      archive.month) ==
-                                                     (entry[0].year,
-                                                      entry[0].month)]
-        return self.index
-
-    def read_post(self, entry):
-        date, pid, cats = entry
-        post = dict()
-        post['date'] = date
-        post['id'] = pid
-        with open(os.path.join(self.entries_dir,
-                               self.build_file_name(entry))) as f:
-            preview, full = False, False
-            for line in f:
-                if line.startswith('categories:') and 'categories' not in post:
-                    post['categories'] = [category.strip() for category in
-                                          line.lstrip('categories:').split(",")]
-                    preview, full = False, False
-                elif line.startswith('title:') and 'title' not in post:
-                    post['title'] = line.lstrip('title:').strip()
-                    preview, full = False, False
-                elif line.startswith('preview:') and not preview \
-                        and 'preview' not in post:
-                    preview, full = True, False
-                    post['preview'] = line.lstrip('preview:').lstrip()
-                elif line.startswith('full:') and not full \
-                        and 'full' not in post:
-                    preview, full = False, True
-                    post['full'] = line.lstrip('full:').lstrip()
-                elif preview:
-                    post['preview'] += line
-                elif full:
-                    post['full'] += line
-        if 'categories' not in post:
-            post['categories'] = []
+            start, end = state.archive_ranges.get(archive, (0, 0))
+            return state.entries[start:end]
+        return state.entries
+
+    def read_post(self, entry, full=True):
+        file_name = self.build_file_name(entry)
+        if not full and file_name in self._index_posts:
+            post = dict(self._index_posts[file_name])
+            post['date'], post['id'] = entry.date, entry.pid
+            return post
+        stat_info = self._index_files.get(file_name)
+        if stat_info:
+            mtime = stat_info[0]
+        else:
+            mtime = os.stat(os.path.join(self.entries_dir,
+                                         file_name)).st_mtime
+        cached = self._posts.get(file_name)
+        if cached and cached[0] == mtime:
+            scanned = cached[1]
+            if full and 'full' in scanned['spans'] and \
+                    'full' not in scanned['texts']:
+                scanned['texts']['full'] = \
+                    self._read_span(file_name, scanned['spans']['full'])
+                self._posts.put(file_name, cached,
+                                self._scanned_size(scanned))
+        else:
+            scanned = self._scan_post(file_name, full)
+            self._posts.put(file_name, (mtime, scanned),
+                            self._scanned_size(scanned))
+        post = dict(scanned['texts'])
+        post['date'] = entry.date
+        post['id'] = entry.pid
+        post['categories'] = scanned['categories']
+        post['has_full'] = 'full' in scanned['spans']
+        if 'title' in scanned:
+            post['title'] = scanned['title']
+        return post
+
+    @staticmethod
+    def _scanned_size(scanned):
+        return sum(len(text) for text in scanned['texts'].itervalues())
+
+    def _parse_post(self, entry, file_name):
+        scanned = self._scan_post(file_name, True)
+        post = dict(scanned['texts'])
+        post['date'], post['id'] = entry.date, entry.pid
+        post['categories'] = scanned['categories']
+        if 'title' in scanned:
+            post['title'] = scanned['title']
         return post
 
+    def _read_span(self, file_name, span):
+        with open_for_reading(os.path.join(self.entries_dir,
+                                           file_name)) as f:
+            f.seek(span[0])
+            return f.read(span[1] - span[0])
+
+    _re_section = re.compile('^(title|categories|preview|full):', re.M)
+
+    def _scan_post(self, file_name, full=True):
+        scanned = {'categories': [], 'spans': dict(), 'texts': dict()}
+        spans = scanned['spans']
+        with open_for_reading(os.path.join(self.entries_dir,
+                                           file_name)) as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return scanned
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                section, headers = None, set()
+                for matched in self._re_section.finditer(m):
+                    kind, start = matched.group(1), matched.start()
+                    line_end = m.find('\n', start)
+                    line_end = size if line_end < 0 else line_end + 1
+                    if kind in ('title', 'categories'):
+                        if kind in headers:
+                            continue
+                        headers.add(kind)
+                        value = m[matched.end():line_end]
+                        if kind == 'title':
+                            scanned['title'] = value.strip()
+                        else:
+                            scanned['categories'] = [
+                                category.strip()
+                                for category in value.split(',')]
+                    elif kind == section or kind in spans:
+                        continue
+                    if section:
+                        spans[section] = (spans[section][0], start)
+                        section = None
+                    if kind in ('preview', 'full'):
+                        text_start = matched.end()
+                        while text_start < line_end and \
+                                m[text_start] in ' \t\r\n\x0b\x0c':
+                            text_start += 1
+                        spans[kind] = (text_start, size)
+                        section = kind
+                for kind, (start, end) in spans.iteritems():
+                    if kind == 'preview' or full or 'preview' not in spans:
+                        scanned['texts'][kind] = m[start:end]
+            finally:
+                m.close()
+        return scanned
+
     def list_archive(self):
-        archive = list()
-        year, month = None, None
-        for date, _, _ in self.index:
-            if (date.year, date.month) != (year, month):
-                archive.append(str(date.year) + "-" + str(date.month))
-                year, month = date.year, date.month
+        archive = self._archive_ranges.keys()
+        archive.sort(reverse=True)
         return archive
 
     def list_categories(self):
-        categories = set()
-        for _, _, cats in self.index:
-            categories.update(cats)
-        categories = list(categories)
+        categories = self._category_positions.keys()
         categories.sort()
         return categories
 
+    def aside(self, app_uri):
+        aside = self._asides.get(app_uri)
+        if aside is None:
+            fmt_categories = "".join(
+                [self._tpl_aside_entry.substitute(link=app_uri + '/category/' +
+                                                  quote_plus(cat), title=cat)
+                 for cat in self.categories])
+            archive = self.archive
+            if self.aside_archive_limit > 0:
+                archive = archive[:self.aside_archive_limit]
+            fmt_months = [self._tpl_aside_entry.
+                          substitute(link=app_uri + '/archive/' + arc,
+                                     title=arc) for arc in archive]
+            if self.aside_archive_by_year:
+                years = list()
+                for arc, fmt_month in zip(archive, fmt_months):
+                    if not years or years[-1][0] != arc[:4]:
+                        years.append((arc[:4], []))
+                    years[-1][1].append(fmt_month)
+                fmt_archive = "".join(
+                    [self._tpl_aside_year.
+                     substitute(year=year, months="".join(months),
+                                open=' open' if not idx else '')
+                     for idx, (year, months) in enumerate(years)])
+            else:
+                fmt_archive = "".join(fmt_months)
+            aside = self._tpl_aside.substitute(categories=fmt_categories,
+                                               archive=fmt_archive)
+            self._asides.put(app_uri, aside)
+        return aside
+
     @staticmethod
     def build_base_uri(app_uri, category, archive, page):
         uri = app_uri
         if category:
-            uri += '/category/' + category
+            uri += '/category/' + quote_plus(category)
         elif archive:
             uri += '/archive/' + archive
         if page:
@@ -374,69 +1991,92 @@ class Blog(object):
         return uri
 
     def build_file_name(self, entry):
-        date, pid, _ = entry
-        return pid + self.file_name_sep + date.strftime('%Y-%m-%d') + '.txt'
+        date = entry.date
+        file_name = entry.pid + self.file_name_sep + \
+            date.strftime('%Y-%m-%d') + '.txt'
+        if self.sharded_layout:
+            return os.path.join(date.strftime('%Y'), date.strftime('%m'),
+                                file_name)
+        return file_name
 
     def find_entry(self, archive, pid):
         try:
             date = datetime.strptime(archive, '%Y-%m-%d')
-            entry = next(entry for entry in self.index
-                         if (date, pid) == entry[0:2])
-            return entry if entry else None
         except ValueError:
             return None
+        return self.state.entries.find(date.toordinal(), pid)
 
     def get_comment(self, comments, comments_num):
-        comment = None
-        level = 0
-        while comments_num:
-            index = comments_num[0]
-            if level == self.comments_nesting:
-                return comment
-            if index < len(comments):
-                comment = comments[index]
-                comments, comments_num = comment[4], comments_num[1:]
-            else:
-                comment, comments_num = None, None
-            level += 1
-        return comment
+        return self._comment_store.get_comment(comments, comments_num)
 
     def gather_comments(self, app_uri, comments, archive, pid, token, admin):
+        return ("".join(self.stream_comments(app_uri, comments, archive, pid,
+                                             token, admin)),
+                self.count_comments(comments))
+
+    def stream_comments(self, app_uri, comments, archive, pid, token, admin,
+                        offset=0, chunk_size=8192):
         reply_url = app_uri + '/post/' + archive + '/' + pid
         delete_url = app_uri + '/delete/' + archive + '/' + pid
 
-        def _gather_comments(_comments, _buf, _count, ids):
+        def _flatten(_comments, ids):
             for idx, comment in enumerate(_comments):
-                date, _, name, text, replies = comment
-                _ids = list(ids)
-                _ids.append(str(idx))
-                comments_str, comments_count = \
-                    _gather_comments(replies, [], 0, _ids)
-                ids_str = "-".join(_ids)
-                _buf.append(self._tpl_comment.
-                            substitute(name=cgi.escape(name) or 'anonymous',
-                                       time=date.strftime('%Y/%m/%d @ %H:%M'),
-                                       reply_url=reply_url, id=ids_str,
-                                       comment=cgi.escape(text),
-                                       delete_url=self._tpl_link.
-                                       substitute(link=delete_url + '/' +
-                                                  ids_str,
-                                                  title='X') if admin else '',
-                                       comments=comments_str, token=token))
-                _count += comments_count + 1
-            return "".join(_buf), _count
-        buf, count = _gather_comments(comments, [], 0, [])
-        return "".join(buf), count
+                _ids = ids + [str(idx)]
+                yield comment, _ids
+                for reply in _flatten(comment[4], _ids):
+                    yield reply
+
+        def _stream_comment(comment, ids, level):
+            date, _, name, text, replies = comment
+            ids_str = "-".join(ids)
+            yield self._tpl_comment_head.\
+                substitute(name=cgi.escape(name) or 'anonymous',
+                           time=date.strftime('%Y/%m/%d @ %H:%M'),
+                           reply_url=reply_url, id=ids_str,
+                           comment=cgi.escape(text),
+                           delete_url=self._tpl_link.
+                           substitute(link=delete_url + '/' + ids_str,
+                                      title='X') if admin else '',
+                           token=token)
+            if replies and level < self.comments_nesting:
+                for idx, reply in enumerate(replies):
+                    for chunk in _stream_comment(reply, ids + [str(idx)],
+                                                 level + 1):
+                        yield chunk
+            elif replies:
+                hidden = self.count_comments(replies)
+                yield self._tpl_collapsed_comments.\
+                    substitute(count='1 more reply' if hidden == 1 else
+                               '%d more replies' % hidden)
+                for reply, reply_ids in _flatten(replies, ids):
+                    yield self._tpl_comment_head.\
+                        substitute(name=cgi.escape(reply[2]) or 'anonymous',
+                                   time=reply[0].strftime('%Y/%m/%d @ %H:%M'),
+                                   reply_url=reply_url,
+                                   id="-".join(reply_ids),
+                                   comment=cgi.escape(reply[3]),
+                                   delete_url=self._tpl_link.
+                                   substitute(link=delete_url + '/' +
+                                              "-".join(reply_ids),
+                                              title='X') if admin else '',
+                                   token=token)
+                    yield self._tpl_comment_tail.substitute()
+                yield '</details>\n'
+            yield self._tpl_comment_tail.substitute()
+
+        buf, size = [], 0
+        for idx, comment in enumerate(comments):
+            for chunk in _stream_comment(comment, [str(offset + idx)], 1):
+                buf.append(chunk)
+                size += len(chunk)
+                if size >= chunk_size:
+                    yield "".join(buf)
+                    buf, size = [], 0
+        if buf:
+            yield "".join(buf)
 
     def load_comments(self, archive, pid):
-        comments_path = os.path.join(self.comments_dir,
-                                     pid + self.file_name_sep + archive +
-                                     '.comments')
-        if os.path.exists(comments_path):
-            with open(comments_path, 'rb') as f:
-                return cPickle.load(f)
-        else:
-            return list()
+        return self._comment_store.load(archive, pid)
 
     def count_comments(self, comments):
         if comments:
@@ -446,18 +2086,257 @@ class Blog(object):
             return count
         return 0
 
+    def _start_watcher(self):
+        with self._watcher_lock:
+            if self._watcher and self._watcher.pid == os.getpid():
+                return
+            self._watcher = Watcher([self.entries_dir, self.comments_dir,
+                                     self.indices_dir], self._on_change,
+                                    self.watch_debounce,
+                                    self.watch_poll_interval, self._logger)
+            if self.sharded_layout:
+                self._watcher.watch(self._shard_dirs())
+
+    def _shard_dirs(self):
+        dirs = set()
+        for shard in list_shards(self.entries_dir):
+            dirs.add(os.path.join(self.entries_dir, os.path.dirname(shard)))
+            dirs.add(os.path.join(self.entries_dir, shard))
+        return dirs
+
+    def _on_change(self, changed):
+        shards = [os.path.relpath(path, self.entries_dir) for path in changed
+                  if path.startswith(self.entries_dir + os.sep)]
+        if self.entries_dir in changed or shards:
+            with self._state_lock:
+                self.refresh_index(rescan=[shard for shard in shards
+                                           if os.sep in shard])
+            if self.sharded_layout:
+                self._watcher.watch(self._shard_dirs())
+        if self.comments_dir in changed or self.indices_dir in changed:
+            self._reload_comments_index()
+
     def configure(self):
-        main_index_path = os.path.join(self.indices_dir, 'main.index')
-        if not os.path.exists(main_index_path):
-            self.index = self._try_main_index(main_index_path)
-            self.categories = self.list_categories()
-            self.archive = self.list_archive()
+        if self.watch_index:
+            if self._watcher.pid != os.getpid():
+                self._start_watcher()
+            return
+        if self.index_refresh_interval < 0:
+            return
+        now = time.time()
+        if now - self._index_checked_at < self.index_refresh_interval or \
+                not self._state_lock.acquire(False):
+            return
+        try:
+            if now - self._index_checked_at >= self.index_refresh_interval:
+                self._index_checked_at = now
+                if self.refresh_entries:
+                    self.refresh_index()
+                self._reload_comments_index()
+        finally:
+            self._state_lock.release()
+
+    def _validators(self, key, entries, *versions):
+        mtimes = [self._index_files.get(self.build_file_name(entry),
+                                        (0, 0))[0] for entry in entries]
+        m = hashlib.sha1()
+        m.update(repr((key, self._index_mtime, mtimes, versions)))
+        return '"%s"' % m.hexdigest(), max([self._index_mtime] + mtimes)
+
+    def _not_modified(self, rc, etag, last_modified):
+        if_none_match = rc.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in tags or '*' in tags
+        if_modified_since = rc.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            parsed = parsedate_tz(if_modified_since.split(';')[0])
+            if parsed:
+                return int(last_modified) <= mktime_tz(parsed)
+        return False
+
+    def _negotiate_encoding(self, rc):
+        if not self.compression_level:
+            return None
+        accepted = dict()
+        for item in rc.environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            params = item.split(';')
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if params[0].strip():
+                accepted[params[0].strip().lower()] = quality
+        for encoding in self.compression_encodings:
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return None
+
+    def _compress(self, body, encoding):
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED,
+                                      self._compressors[encoding])
+        return compressor.compress(body) + compressor.flush()
+
+    def _cached(self, rc, key, render, tags=lambda: (), validators=None,
+                stream=False):
+        encoding = self._negotiate_encoding(rc)
+        extra_headers = [('Vary', 'Accept-Encoding')]
+        if encoding:
+            extra_headers.append(('Content-Encoding', encoding))
+        if validators:
+            etag, last_modified = validators
+            if encoding:
+                etag = etag[:-1] + '-' + encoding + '"'
+            extra_headers += [('ETag', etag),
+                              ('Last-Modified',
+                               formatdate(last_modified, usegmt=True))]
+            if self._not_modified(rc, etag, last_modified):
+                rc.response(self._statuses[304], [
+                    header for header in extra_headers
+                    if header[0] != 'Content-Encoding'])
+                return ['']
+        cached = self._responses.get(key)
+        if cached:
+            created, status, headers, bodies, cached_validators = cached
+            if cached_validators == validators and \
+                    (not self.response_cache_max_age or
+                     time.time() - created < self.response_cache_max_age):
+                body = bodies.get(encoding)
+                if body is None:
+                    body = bodies[encoding] = \
+                        self._compress(bodies[None], encoding)
+                    self._responses.put(key, cached, sum(
+                        len(variant) for variant in bodies.itervalues()),
+                        self._responses.tags(key))
+                rc.response(status, headers + extra_headers +
+                            [('Content-Length', str(len(body)))])
+                return [body]
+        if stream:
+            return self._stream_and_cache(rc, key, render, tags, encoding,
+                                          extra_headers, validators)
+        response, captured = rc.response, []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+        rc.response = capture
+        try:
+            body = "".join(render)
+        finally:
+            rc.response = response
+        status, headers = captured
+        if status != self._statuses[200]:
+            response(status, headers)
+            return [body]
+        bodies = {None: body}
+        if encoding:
+            body = bodies[encoding] = self._compress(body, encoding)
+        response(status, headers + extra_headers +
+                 [('Content-Length', str(len(body)))])
+        self._responses.put(key, (time.time(), status, headers, bodies,
+                                  validators),
+                            sum(len(variant) for variant
+                                in bodies.itervalues()), tags())
+        return [body]
+
+    def _stream_and_cache(self, rc, key, render, tags, encoding,
+                          extra_headers, validators):
+        response, captured = rc.response, []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+            if status == self._statuses[200]:
+                headers = headers + extra_headers
+            return response(status, headers)
+        rc.response = capture
+        compressor = None
+        if encoding:
+            compressor = zlib.compressobj(self.compression_level,
+                                          zlib.DEFLATED,
+                                          self._compressors[encoding])
+        chunks, compressed, size = [], [], 0
+        try:
+            for chunk in render:
+                if captured[0] != self._statuses[200]:
+                    yield chunk
+                    continue
+                if chunks is not None:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if 0 < self._responses.max_bytes < size:
+                        chunks = None
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                    if chunks is not None:
+                        compressed.append(chunk)
+                if chunk:
+                    yield chunk
+            if compressor and captured[0] == self._statuses[200]:
+                chunk = compressor.flush()
+                compressed.append(chunk)
+                yield chunk
+        finally:
+            rc.response = response
+        if captured[0] == self._statuses[200] and chunks is not None:
+            bodies = {None: "".join(chunks)}
+            if encoding:
+                bodies[encoding] = "".join(compressed)
+            self._responses.put(key, (time.time(), captured[0], captured[1],
+                                      bodies, validators),
+                                sum(len(variant) for variant
+                                    in bodies.itervalues()), tags())
+
+    def cached_list(self, rc, category=None, archive=None, page=1):
+        key = ('list', rc.app_uri, category, archive, page)
+        entries = self.filter_entries(category, archive)
+        items_to = self.items_per_page * page
+        page_entries = entries[items_to - self.items_per_page:items_to]
+        validators = None
+        if page > 0 and (not category or
+                         category in self._category_positions) and \
+                (not archive or archive in self._archive_ranges):
+            etag, last_modified = self._validators(
+                key, page_entries, len(entries),
+                [self.comment_count(entry.date.strftime('%Y-%m-%d'),
+                                    entry.pid) for entry in page_entries])
+            validators = etag, max(last_modified,
+                                   self._comments_index_mtime or 0)
+        return self._cached(rc, key,
+                            self.get_list(rc, category, archive, page),
+                            lambda: [('entry', entry.ordinal, entry.pid)
+                                     for entry in page_entries], validators)
+
+    def cached_post(self, rc, archive, pid, admin=False, page=1):
+        key = ('post', rc.app_uri, archive, pid, admin, page)
+        entry = self.find_entry(archive, pid)
+        validators = None
+        if entry:
+            comments_mtime = self._comment_store.mtime(archive, pid)
+            etag, last_modified = self._validators(key, [entry],
+                                                   comments_mtime)
+            validators = etag, max(last_modified, comments_mtime)
+        return self._cached(rc, key,
+                            self.get_post(rc, archive, pid, admin, page),
+                            lambda: [('entry', entry.ordinal, entry.pid)]
+                            if entry else [], validators, stream=True)
+
+    def cached_rss(self, rc, category=None):
+        key = ('rss', rc.app_uri, category)
+        validators = None
+        if not category or category in self._category_positions:
+            validators = self._validators(
+                key, self.filter_entries(category, None)[:self.items_per_feed])
+        return self._cached(rc, key, self.get_rss(rc, category),
+                            validators=validators)
 
     def get_list(self, rc, category=None, archive=None, page=1):
         if page > 0:
-            if category and category not in self.categories:
+            if category and category not in self._category_positions:
                 yield self.status(rc, 404, 'Category %s not found' % category)
-            elif archive and archive not in self.archive:
+            elif archive and archive not in self._archive_ranges:
                 yield self.status(rc, 404, 'Archive %s not found' % archive)
             else:
                 rc.response(self._statuses[200], [('Content-Type',
@@ -465,93 +2344,118 @@ class Blog(object):
                                                    self._encoding)])
                 yield self._tpl_header.\
                     substitute(base=rc.app_uri, feed_url=rc.app_uri + '/rss'
-                               + ('/' + category if category else ''),
+                               + ('/' + quote_plus(category) if category
+                                  else ''),
                                title=cgi.escape(self.title, quote=True),
                                encoding=self._encoding.lower(), body_tag='')
                 yield self._tpl_entries_begin
                 entries = self.filter_entries(category, archive)
                 items_to = self.items_per_page * page
                 for entry in entries[items_to - self.items_per_page:items_to]:
-                    post = self.read_post(entry)
-                    date_for_link = post['date'].strftime('%Y-%m-%d')
-                    fmt_categories = ", ".join(
-                        [self._tpl_link.substitute(link=rc.app_uri +
-                                                   '/category/' +
-                                                   quote_plus(cat), title=cat)
-                         for cat in post['categories']])
-                    if 'preview' in post:
-                        post_text = post['preview']
-                        if 'full' in post:
-                            post_text += self._tpl_link.substitute(
-                                link=rc.app_uri + '/post/' + date_for_link +
-                                '/' + post['id'], title='View full post &rarr;')
-                    elif 'full' in post:
-                        post_text = post['full']
-                    else:
-                        post_text = ''
-                    title = self.\
-                        _tpl_link.substitute(link=rc.app_uri + '/post/' +
-                                             date_for_link + '/' + post['id'],
-                                             title=post['title'])
-                    comments_count = self.\
-                        count_comments(self.load_comments(date_for_link,
-                                                          post['id']))
-                    comments_str = 'No comments'
-                    if comments_count == 1:
-                        comments_str = '1 comment'
-                    elif comments_count > 1:
-                        comments_str = '%d comments' % comments_count
-                    comments_str = self._tpl_link.\
-                        substitute(link=rc.app_uri + '/post/' +
-                                   date_for_link + '/' + post['id'] +
-                                   '#comments', title=comments_str)
-                    yield self._tpl_entry.\
-                        substitute(title=title, categories=fmt_categories,
-                                   time=post['date'].strftime('%Y/%m/%d'),
-                                   text=post_text, comments=comments_str)
+                    yield self.format_entry(rc, entry)
                 yield self._tpl_entries_end
-                fmt_categories = "".join(
-                    [self._tpl_aside_entry.substitute(link=rc.app_uri +
-                                                      '/category/' +
-                                                      quote_plus(cat),
-                                                      title=cat)
-                     for cat in self.categories])
-                fmt_archive = "".join(
-                    [self._tpl_aside_entry.substitute(link=rc.app_uri +
-                                                      '/archive/' +
-                                                      quote_plus(arc),
-                                                      title=arc)
-                     for arc in self.archive])
-                yield self._tpl_aside.substitute(categories=fmt_categories,
-                                                 archive=fmt_archive)
-                older_newer = ''
-                if entries:
-                    if items_to < len(entries):
-                        older_newer = self.\
-                            _tpl_link_wth_cls.\
-                            substitute(link=Blog.build_base_uri(rc.app_uri,
-                                                                category,
-                                                                archive,
-                                                                page + 1),
-                                       cls='older',
-                                       title='&#9668;&nbsp;Older')
-                    if page > 1 and items_to - self.items_per_page < \
-                            len(entries):
-                        older_newer += self.\
-                            _tpl_link_wth_cls.\
-                            substitute(link=Blog.build_base_uri(rc.app_uri,
-                                                                category,
-                                                                archive,
-                                                                page - 1),
-                                       cls='newer',
-                                       title='Newer&nbsp;&#9658;')
+                yield self.aside(rc.app_uri)
+                older_newer = self.format_older_newer(
+                    entries, page, lambda other: Blog.build_base_uri(
+                        rc.app_uri, category, archive, other))
                 yield self._tpl_footer.substitute(links=older_newer)
         else:
             yield self.status(rc, 404, 'Page %d not found' % page)
 
-    def get_post(self, rc, archive, pid, admin=False):
+    def format_entry(self, rc, entry):
+        post = self.read_post(entry, full=False)
+        date_for_link = post['date'].strftime('%Y-%m-%d')
+        fmt_categories = ", ".join(
+            [self._tpl_link.substitute(link=rc.app_uri + '/category/' +
+                                       quote_plus(cat), title=cat)
+             for cat in post['categories']])
+        if 'preview' in post:
+            post_text = post['preview']
+            if post['has_full']:
+                post_text += self._tpl_link.substitute(
+                    link=rc.app_uri + '/post/' + date_for_link + '/' +
+                    post['id'], title='View full post &rarr;')
+        elif 'full' in post:
+            post_text = post['full']
+        else:
+            post_text = ''
+        title = self._tpl_link.substitute(link=rc.app_uri + '/post/' +
+                                          date_for_link + '/' + post['id'],
+                                          title=post['title'])
+        comments_count = self.comment_count(date_for_link, post['id'])
+        comments_str = 'No comments'
+        if comments_count == 1:
+            comments_str = '1 comment'
+        elif comments_count > 1:
+            comments_str = '%d comments' % comments_count
+        comments_str = self._tpl_link.\
+            substitute(link=rc.app_uri + '/post/' + date_for_link + '/' +
+                       post['id'] + '#comments', title=comments_str)
+        return self._tpl_entry.\
+            substitute(title=title, categories=fmt_categories,
+                       time=post['date'].strftime('%Y/%m/%d'),
+                       text=post_text, comments=comments_str)
+
+    def format_older_newer(self, entries, page, build_uri):
+        older_newer = ''
+        items_to = self.items_per_page * page
+        if entries:
+            if items_to < len(entries):
+                older_newer = self._tpl_link_wth_cls.\
+                    substitute(link=build_uri(page + 1), cls='older',
+                               title='&#9668;&nbsp;Older')
+            if page > 1 and items_to - self.items_per_page < len(entries):
+                older_newer += self._tpl_link_wth_cls.\
+                    substitute(link=build_uri(page - 1), cls='newer',
+                               title='Newer&nbsp;&#9658;')
+        return older_newer
+
+    def get_search(self, rc):
+        params = parse_qs(rc.environ.get('QUERY_STRING', ''))
+        query = params.get('q', [''])[0]
+        try:
+            page = int(params.get('page', ['1'])[0])
+        except ValueError:
+            page = 0
+        if page > 0:
+            rc.response(self._statuses[200], [('Content-Type',
+                                               'text/html; charset=%s' %
+                                               self._encoding)])
+            yield self._tpl_header.\
+                substitute(base=rc.app_uri, feed_url=rc.app_uri + '/rss',
+                           title=cgi.escape(self.title, quote=True),
+                           encoding=self._encoding.lower(), body_tag='')
+            yield self._tpl_entries_begin
+            entries = self.search(query)
+            yield self._tpl_search_title.\
+                substitute(query=cgi.escape(query, quote=True),
+                           count=len(entries))
+            items_to = self.items_per_page * page
+            for entry in entries[items_to - self.items_per_page:items_to]:
+                yield self.format_entry(rc, entry)
+            yield self._tpl_entries_end
+            yield self.aside(rc.app_uri)
+            older_newer = self.format_older_newer(
+                entries, page, lambda other: cgi.escape(
+                    rc.app_uri + '/search?' + urlencode({'q': query,
+                                                         'page': other}),
+                    quote=True))
+            yield self._tpl_footer.substitute(links=older_newer)
+        else:
+            yield self.status(rc, 404, 'Page %d not found' % page)
+
+    def get_post(self, rc, archive, pid, admin=False, page=1):
         entry = self.find_entry(archive, pid)
-        if entry:
+        start, end = 0, None
+        if self.comments_per_page > 0:
+            start, end = (page - 1) * self.comments_per_page, \
+                page * self.comments_per_page
+        comments, top_count, count = [], 0, 0
+        if entry and 0 < page:
+            comments, top_count, count = self._comment_store.load_page(
+                archive, pid, start, end)
+        if entry and 0 < page and (page == 1 or
+                                   (end is not None and start < top_count)):
             post = self.read_post(entry)
             rc.response(self._statuses[200], [('Content-Type',
                                                'text/html; charset=%s' %
@@ -575,40 +2479,38 @@ class Blog(object):
                 post_text = post['preview']
             else:
                 post_text = ''
-            comments_path = os.path.join(self.comments_dir, pid +
-                                         self.file_name_sep + archive +
-                                         '.comments')
             comments_title = 'No comments'
-            comments_str = ''
-            if os.path.exists(comments_path):
-                with open(comments_path, 'rb') as f:
-                    comments = cPickle.load(f)
-                comments_str, count = self.gather_comments(rc.app_uri, comments,
-                                                           archive, pid, token,
-                                                           admin)
-                if count == 1:
-                    comments_title = '1 comment'
-                elif count > 1:
-                    comments_title = '%d comments' % count
-            yield self._tpl_post.\
+            if count == 1:
+                comments_title = '1 comment'
+            elif count > 1:
+                comments_title = '%d comments' % count
+            yield self._tpl_post_head.\
                 substitute(title=post['title'], categories=fmt_categories,
                            time=post['date'].strftime('%Y/%m/%d'),
                            text=post_text, comments_title=comments_title,
-                           comments=comments_str, reply_url=rc.app_uri +
-                           '/post/' + archive + '/' + pid, token=token)
+                           reply_url=rc.app_uri + '/post/' + archive + '/' +
+                           pid, token=token)
+            for chunk in self.stream_comments(rc.app_uri, comments, archive,
+                                              pid, token, admin,
+                                              offset=start):
+                yield chunk
+            yield self._tpl_post_tail.substitute()
             yield self._tpl_entries_end
-            fmt_categories = "".join(
-                [self._tpl_aside_entry.substitute(link=rc.app_uri +
-                                                  '/category/' +
-                                                  quote_plus(cat), title=cat)
-                 for cat in self.categories])
-            fmt_archive = "".join(
-                [self._tpl_aside_entry.substitute(link=rc.app_uri +
-                                                  '/archive/' + quote_plus(arc),
-                                                  title=arc)
-                 for arc in self.archive])
-            yield self._tpl_aside.substitute(categories=fmt_categories,
-                                             archive=fmt_archive)
+            yield self.aside(rc.app_uri)
+            post_uri = rc.app_uri + '/post/' + archive + '/' + pid
+            older_newer = ''
+            if end is not None and end < top_count:
+                older_newer = self._tpl_link_wth_cls.\
+                    substitute(link=post_uri + '/comments/page/' +
+                               str(page + 1) + '#comments', cls='older',
+                               title='&#9668;&nbsp;Older comments')
+            if page > 1:
+                older_newer += self._tpl_link_wth_cls.\
+                    substitute(link=(post_uri + '/comments/page/' +
+                                     str(page - 1) if page > 2 else
+                                     post_uri) + '#comments', cls='newer',
+                               title='Newer comments&nbsp;&#9658;')
+            yield self._tpl_footer.substitute(links=older_newer)
         else:
             yield self.status(rc, 404, 'Post %s not found' % archive + '/' +
                                        pid)
@@ -629,24 +2531,13 @@ class Blog(object):
                 substitute(url=rc.app_uri + '/delete/' + archive + '/' + pid,
                            ids=ids_str)
             yield self._tpl_entries_end
-            fmt_categories = "".join(
-                [self._tpl_aside_entry.substitute(link=rc.app_uri +
-                                                  '/category/' +
-                                                  quote_plus(cat), title=cat)
-                 for cat in self.categories])
-            fmt_archive = "".join(
-                [self._tpl_aside_entry.substitute(link=rc.app_uri +
-                                                  '/archive/' + quote_plus(arc),
-                                                  title=arc)
-                 for arc in self.archive])
-            yield self._tpl_aside.substitute(categories=fmt_categories,
-                                             archive=fmt_archive)
+            yield self.aside(rc.app_uri)
         else:
             yield self.status(rc, 404, 'Post %s not found' % archive + '/' +
                                        pid)
 
     def get_rss(self, rc, category=None):
-        if category and category not in self.categories:
+        if category and category not in self._category_positions:
             yield self.status(rc, 404, 'Category %s not found' % category)
         else:
             rc.response(self._statuses[200], [('Content-Type',
@@ -657,18 +2548,19 @@ class Blog(object):
             entries = self.filter_entries(category, None)
             updated = datetime(1986, 4, 26)
             if entries:
-                updated = entries[0][0].strftime(datetime_format)
+                updated = entries[0].date.strftime(datetime_format)
             yield self._tpl_feed_begin.\
                 substitute(encoding=self._encoding.lower(),
                            self_url=rc.app_uri + '/rss' +
-                           ('/' + category if category else ''),
+                           ('/' + quote_plus(category) if category else ''),
                            title=self.title,
                            author=self.author, url=rc.app_uri +
-                           ('/category/' + category if category else ''),
+                           ('/category/' + quote_plus(category) if category
+                            else ''),
                            id=rc.app_uri + ('/category/' +
                            category if category else ''), updated=updated)
             for entry in entries[:self.items_per_feed]:
-                post = self.read_post(entry)
+                post = self.read_post(entry, full=False)
                 date_for_link = post['date'].strftime('%Y-%m-%d')
                 post_text = ''
                 if 'preview' in post:
@@ -706,19 +2598,12 @@ class Blog(object):
                     comments_no = [int(comment_no) for comment_no
                                    in comments_no_str.split("-")] if \
                         comments_no_str else []
-                    path_comment_file = os.path.\
-                        join(self.comments_dir, pid + self.file_name_sep +
-                             archive + '.comments')
-                    comments = list()
-                    if os.path.exists(path_comment_file):
-                        with open(path_comment_file, 'rb') as f:
-                            comments = cPickle.load(f)
-                    parent_comment = self.get_comment(comments, comments_no)
-                    replies = parent_comment[4] if parent_comment else comments
-                    replies.append((datetime.now(), email, name, comment, []))
-                    replies.sort(key=lambda c: c[0], reverse=True)
-                    self._serialize_object(comments, path_comment_file,
-                                           force=True)
+                    self._comment_store.append(archive, pid, (
+                        'add', comments_no,
+                        (datetime.now(), email, name, comment)))
+                    self._store_comment_count(archive, pid, delta=1)
+                    self._responses.invalidate(('entry', entry.ordinal,
+                                                entry.pid))
                     self.redirect(rc, '/post/' + archive + '/' + pid)
                 except ValueError:
                     yield self.status(rc, 401, 'I cannot understand comment_no '
@@ -751,23 +2636,16 @@ class Blog(object):
                            in ids_str.split("-")] if ids_str else []
                     if not ids:
                         raise ValueError()
-                    path_comment_file = os.path.\
-                        join(self.comments_dir, pid + self.file_name_sep +
-                             archive + '.comments')
-                    if os.path.exists(path_comment_file):
-                        with open(path_comment_file, 'rb') as f:
-                            comments = cPickle.load(f)
-                        id_to_delete = ids.pop()
-                        parent_comment = self.get_comment(comments, ids)
-                        replies = comments if not ids else \
-                            (parent_comment[4] if parent_comment else [])
-                        if id_to_delete < len(replies):
-                            del replies[id_to_delete]
-                            self._serialize_object(comments, path_comment_file,
-                                                   force=True)
-                        else:
-                            self._logger.warn('Comment was not deleted. '
-                                              'comment_no is [%s]', ids_str)
+                    comments = self._comment_store.append(archive, pid,
+                                                          ('delete', ids))
+                    if comments is not None:
+                        self._store_comment_count(
+                            archive, pid, count=self.count_comments(comments))
+                        self._responses.invalidate(('entry', entry.ordinal,
+                                                    entry.pid))
+                    else:
+                        self._logger.warn('Comment was not deleted. '
+                                          'comment_no is [%s]', ids_str)
                     self.redirect(rc, '/post/' + archive + '/' + pid)
                 except ValueError:
                     yield self.status(rc, 400, 'I cannot understand ids [%s] '
@@ -782,56 +2660,42 @@ class Blog(object):
                                        pid)
 
     def __call__(self, environ, start_response):
+        if self.metrics:
+            return self.metrics(environ, start_response, self.dispatch)
+        return self.dispatch(environ, start_response)
+
+    def dispatch(self, environ, start_response):
         self.configure()
         rc = RequestContext(environ, start_response)
-        if rc.method == 'GET':
-            if not rc.path or rc.path == '/':
-                return self.get_list(rc)
-            elif re.match('^/page/\d+/?$', rc.path):
-                return self.get_list(rc, page=int(rc.path.split('/')[2]))
-            elif re.match('^/category/[^/]+/?$', rc.path):
-                return self.get_list(rc, category=unquote_plus(
-                    rc.path.split('/')[2]))
-            elif re.match('^/category/[^/]+/page/\d+/?$', rc.path):
-                path_els = rc.path.split('/')
-                return self.get_list(rc, category=unquote_plus(path_els[2]),
-                                     page=int(path_els[4]))
-            elif re.match('^/archive/\d{4}-\d{2}/?$', rc.path):
-                return self.get_list(rc, archive=rc.path.split('/')[2])
-            elif re.match('^/archive/\d{4}-\d{2}/page/\d+/?$', rc.path):
-                path_els = rc.path.split('/')
-                return self.get_list(rc, archive=path_els[2],
-                                     page=int(path_els[4]))
-            elif re.match('^/post/\d{4}-\d{2}-\d{2}/[^/]+/?$', rc.path):
-                path_els = rc.path.split('/')
-                return self.get_post(rc, archive=path_els[2],
-                                     pid=unquote_plus(path_els[3]))
-            elif re.match('^/post/\d{4}-\d{2}-\d{2}/[^/]+/admin/?$', rc.path):
-                path_els = rc.path.split('/')
-                return self.get_post(rc, archive=path_els[2],
-                                     pid=unquote_plus(path_els[3]),
-                                     admin=True)
-            elif re.match('^/delete/\d{4}-\d{2}-\d{2}/[^/]+/\d+(-\d+)*/?$',
-                          rc.path):
-                path_els = rc.path.split('/')
-                return self.get_delete_comment(rc, archive=path_els[2],
-                                               pid=unquote_plus(path_els[3]),
-                                               ids_str=path_els[4])
-            elif re.match('^/rss/?$', rc.path):
-                return self.get_rss(rc)
-            elif re.match('^/rss/[^/]+/?$', rc.path):
-                return self.get_rss(rc.path.split('/')[2])
-        elif rc.method == 'POST':
-            if re.match('^/post/\d{4}-\d{2}-\d{2}/[^/]+/?$', rc.path):
-                path_els = rc.path.split('/')
-                return self.post_comment(rc, archive=path_els[2],
-                                         pid=unquote_plus(path_els[3]))
-            elif re.match('^/delete/\d{4}-\d{2}-\d{2}/[^/]+/\d+(-\d+)*/?$',
-                          rc.path):
-                path_els = rc.path.split('/')
-                return self.post_delete_comment(rc, path_els[2],
-                                                unquote_plus(path_els[3]),
-                                                path_els[4])
+        handler, params, pattern = self.router.match(rc.method,
+                                                     rc.path or '/')
+        if handler:
+            environ['tohtkiri.route'] = pattern
+            return getattr(self, handler)(rc, **params)
         return self.status(rc, 404, 'Page %s not found' % rc.path)
 
-application = Blog()
\ No newline at end of file
+
+class LazyBlog(object):
+    def __init__(self, conf_path=None):
+        object.__setattr__(self, '_conf_path', conf_path)
+        object.__setattr__(self, '_blog', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    @property
+    def blog(self):
+        if self._blog is None:
+            with self._lock:
+                if self._blog is None:
+                    object.__setattr__(self, '_blog', Blog(self._conf_path))
+        return self._blog
+
+    def __getattr__(self, name):
+        return getattr(self.blog, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.blog, name, value)
+
+    def __call__(self, environ, start_response):
+        return self.blog(environ, start_response)
+
+application = LazyBlog()
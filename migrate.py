@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import argparse
+import os
+import re
+
+from index import Blog, list_shards
+
+_rebuilt_indices = ('main.index', 'comments.index', 'search.index',
+                    'warm.snapshot')
+
+
+def plan_moves(root, re_file_name, sharded):
+    moves = list()
+    if not os.path.isdir(root):
+        return moves
+    if sharded:
+        for file_name in sorted(os.listdir(root)):
+            matched = re_file_name.match(file_name)
+            if matched and os.path.isfile(os.path.join(root, file_name)):
+                date = matched.group(2)
+                moves.append((file_name,
+                              os.path.join(date[:4], date[5:7], file_name)))
+    else:
+        for shard in sorted(list_shards(root)):
+            for file_name in sorted(os.listdir(os.path.join(root, shard))):
+                if re_file_name.match(file_name):
+                    moves.append((os.path.join(shard, file_name), file_name))
+    return moves
+
+
+def move_files(root, moves):
+    for source, target in moves:
+        target_dir = os.path.dirname(os.path.join(root, target))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        os.rename(os.path.join(root, source), os.path.join(root, target))
+    for shard in list_shards(root):
+        for path in (shard, os.path.dirname(shard)):
+            try:
+                os.rmdir(os.path.join(root, path))
+            except OSError:
+                pass
+
+
+def rebuild_indices(blog):
+    for name in _rebuilt_indices:
+        path = os.path.join(blog.indices_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+    with blog._state_lock:
+        blog._search = None
+        blog._load_state()
+        blog._sync_search()
+
+
+def migrate(blog, dry_run=False):
+    sep = re.escape(blog.file_name_sep)
+    plans = [(root, plan_moves(root, re.compile(
+        '^(.+)' + sep + '(\d{4}-\d{2}-\d{2})' + suffix), blog.sharded_layout))
+        for root, suffix in ((blog.entries_dir, '\.txt$'),
+                             (blog.comments_dir,
+                              '\.comments(?:\.log)?$'))]
+    conflicts = [os.path.join(root, target) for root, moves in plans
+                 for _, target in moves
+                 if os.path.exists(os.path.join(root, target))]
+    if conflicts:
+        raise OSError('files already exist: %s' % ', '.join(conflicts))
+    if not dry_run:
+        for root, moves in plans:
+            move_files(root, moves)
+        rebuild_indices(blog)
+    return [(os.path.join(root, source), os.path.join(root, target))
+            for root, moves in plans for source, target in moves]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Moves entries and comments '
+                                                 'between the flat and the '
+                                                 'year/month layout and '
+                                                 'rebuilds the indices')
+    parser.add_argument('--to', choices=('flat', 'sharded'),
+                        help='layout to move the files into; it must match '
+                             'sharded_layout in index.conf')
+    parser.add_argument('--rescan', nargs='+', metavar='YYYY-MM',
+                        help='rescan these months of a sharded layout')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only list the files that would be moved')
+    args = parser.parse_args()
+    blog = Blog(lazy_index=True, watch_index=False)
+    if not args.to and not args.rescan:
+        parser.error('one of --to or --rescan is required')
+    if args.to and (args.to == 'sharded') != blog.sharded_layout:
+        parser.error('set sharded_layout = %r in index.conf first' %
+                     (args.to == 'sharded'))
+    if args.to:
+        try:
+            moves = migrate(blog, args.dry_run)
+        except OSError as e:
+            parser.error(str(e))
+        for source, target in moves:
+            print '%s -> %s' % (source, target)
+        print '%d files %s' % (len(moves), 'to move' if args.dry_run
+                               else 'moved, indices rebuilt')
+    if args.rescan:
+        months = list()
+        for month in args.rescan:
+            if not re.match('\d{4}-\d{2}$', month):
+                parser.error('invalid month: %s' % month)
+            months.append(os.path.join(month[:4], month[5:7]))
+        if not args.dry_run:
+            with blog._state_lock:
+                changed = blog.refresh_index(rescan=months)
+                if changed:
+                    blog._sync_search()
+            print 'index %s' % ('updated' if changed else 'is up to date')
+
+
+if __name__ == '__main__':
+    main()
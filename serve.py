@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import argparse
+import asyncore
+import errno
+import fcntl
+import gc
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from Queue import Queue
+from StringIO import StringIO
+from urllib import unquote
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+import index
+
+
+class PreforkServer(WSGIServer):
+    timeout = 1.0
+    handled = 0
+
+    def get_request(self):
+        request, client_address = WSGIServer.get_request(self)
+        request.setblocking(1)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        WSGIServer.process_request(self, request, client_address)
+
+
+class Trigger(asyncore.file_dispatcher):
+    def __init__(self, channel_map):
+        read_fd, self._write_fd = os.pipe()
+        flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read_fd, channel_map)
+        os.close(read_fd)
+        self._calls = deque()
+
+    def writable(self):
+        return False
+
+    def call(self, func, *args):
+        self._calls.append((func, args))
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
+
+
+class Acceptor(asyncore.dispatcher):
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, server.channels)
+        self.accepting = True
+        self.server = server
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair:
+            Channel(pair[0], pair[1], self.server)
+
+
+class Channel(asyncore.dispatcher):
+    max_header_bytes = 64 * 1024
+    _no_body = ('1', '204', '304')
+
+    def __init__(self, sock, address, server):
+        asyncore.dispatcher.__init__(self, sock, server.channels)
+        self.server = server
+        self.address = address
+        self.busy = False
+        self.closing = False
+        self.continued = False
+        self.active_at = time.time()
+        self.parked = None
+        self._in = ''
+        self._out = deque()
+        self._queued = 0
+        self._queued_lock = threading.Lock()
+
+    def readable(self):
+        return not self.busy and not self.closing
+
+    def writable(self):
+        return bool(self._out)
+
+    def handle_read(self):
+        data = self.recv(64 * 1024)
+        if data:
+            self.active_at = time.time()
+            self._in += data
+            self.parse()
+
+    def handle_write(self):
+        while self._out:
+            data = self._out[0]
+            sent = self.send(data)
+            if not sent:
+                break
+            self.active_at = time.time()
+            if sent < len(data):
+                self._out[0] = data[sent:]
+            else:
+                self._out.popleft()
+            with self._queued_lock:
+                self._queued -= sent
+        if not self._out and self.closing:
+            self.close()
+        self.resume()
+
+    def handle_close(self):
+        self.close()
+        self.resume()
+
+    def park(self, response):
+        self.parked = response
+        self.resume()
+
+    def resume(self):
+        response = self.parked
+        if response is not None and (self._queued <= self.server.window or
+                                     not self.connected):
+            self.parked = None
+            self.server.submit(self.produce, response)
+
+    def parse(self):
+        end = self._in.find('\r\n\r\n')
+        if end < 0:
+            if len(self._in) > self.max_header_bytes:
+                self.reject('431 Request Header Fields Too Large')
+            return
+        lines = self._in[0:end].split('\r\n')
+        try:
+            method, target, version = lines[0].split()
+        except ValueError:
+            self.reject('400 Bad Request')
+            return
+        headers = dict()
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            self.reject('400 Bad Request')
+            return
+        if len(self._in) < end + 4 + length:
+            if not self.continued and \
+                    headers.get('expect', '').lower() == '100-continue':
+                self.continued = True
+                self.push(version + ' 100 Continue\r\n\r\n')
+            return
+        body = self._in[end + 4:end + 4 + length]
+        self._in = self._in[end + 4 + length:]
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' \
+            else version == 'HTTP/1.1' and connection != 'close'
+        self.busy, self.continued = True, False
+        self.server.submit(self.respond, self.build_environ(
+            method, target, version, headers, body), version, keep_alive)
+
+    def build_environ(self, method, target, version, headers, body):
+        path, _, query = target.partition('?')
+        environ = dict(self.server.base_environ)
+        environ.update({'REQUEST_METHOD': method.upper(),
+                        'PATH_INFO': unquote(path), 'QUERY_STRING': query,
+                        'SERVER_PROTOCOL': version,
+                        'REMOTE_ADDR': self.address[0] if self.address
+                        else '', 'CONTENT_LENGTH': str(len(body)),
+                        'wsgi.input': StringIO(body)})
+        for name, value in headers.iteritems():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+                key = 'HTTP_' + key
+            environ[key] = value
+        return environ
+
+    def push(self, data):
+        if self.connected:
+            self._out.append(data)
+            self.handle_write()
+
+    def reject(self, status):
+        self.closing = True
+        self.push('HTTP/1.1 %s\r\nContent-Length: 0\r\n'
+                  'Connection: close\r\n\r\n' % status)
+
+    def finish(self, keep_alive):
+        self.server.handled += 1
+        self.busy = False
+        if not keep_alive:
+            self.closing = True
+            if not self._out:
+                self.close()
+        elif self._in:
+            self.parse()
+
+    def write(self, data):
+        with self._queued_lock:
+            self._queued += len(data)
+        self.server.trigger.call(self.push, data)
+        return self.connected
+
+    def respond(self, environ, version, keep_alive):
+        response = {'version': version, 'environ': environ,
+                    'persistent': keep_alive}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and 'sent' in response:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            response['status'], response['headers'] = status, headers
+            return lambda data: self.send_body(response, data)
+
+        try:
+            response['result'] = self.server.app(environ, start_response)
+            response['chunks'] = iter(response['result'])
+        except Exception:
+            self.complete(response, self.fail(response))
+            return
+        self.produce(response)
+
+    def produce(self, response):
+        try:
+            for chunk in response['chunks']:
+                if chunk and not self.send_body(response, chunk):
+                    break
+                if self._queued > self.server.window:
+                    self.server.trigger.call(self.park, response)
+                    return
+            self.send_body(response, '')
+            if response['chunked']:
+                self.write('0\r\n\r\n')
+            keep_alive = response['persistent'] and response['keep_alive']
+        except Exception:
+            keep_alive = self.fail(response)
+        self.complete(response, keep_alive)
+
+    def fail(self, response):
+        environ = response['environ']
+        self.server.logger.error('request %s %s failed',
+                                 environ['REQUEST_METHOD'],
+                                 environ['PATH_INFO'], exc_info=1)
+        if 'sent' in response:
+            return False
+        self.write('HTTP/1.1 500 Internal Server Error\r\n'
+                   'Content-Length: 0\r\n\r\n')
+        return response['persistent']
+
+    def complete(self, response, keep_alive):
+        try:
+            if hasattr(response.get('result'), 'close'):
+                response['result'].close()
+        finally:
+            self.server.trigger.call(self.finish, keep_alive)
+
+    def send_body(self, response, data):
+        if 'sent' not in response:
+            response['sent'] = True
+            status, headers = response['status'], list(response['headers'])
+            names = set(name.lower() for name, _ in headers)
+            response['chunked'] = False
+            response['keep_alive'] = True
+            if not status.startswith(self._no_body) and \
+                    'content-length' not in names:
+                if response['version'] == 'HTTP/1.1':
+                    headers.append(('Transfer-Encoding', 'chunked'))
+                    response['chunked'] = True
+                else:
+                    response['keep_alive'] = False
+                    headers.append(('Connection', 'close'))
+            head = ['HTTP/1.1 ' + status]
+            head.extend('%s: %s' % header for header in headers)
+            data = '\r\n'.join(head) + '\r\n\r\n' + (
+                '%x\r\n%s\r\n' % (len(data), data)
+                if response['chunked'] and data else data)
+            return self.write(data)
+        if not data:
+            return self.connected
+        if response['chunked']:
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        return self.write(data)
+
+
+class EventLoopServer(object):
+    keep_alive_timeout = 15
+
+    def __init__(self, sock, app, threads, window=256 * 1024):
+        self.app = app
+        self.window = window
+        self.handled = 0
+        self.logger = logging.getLogger('serve')
+        self.channels = dict()
+        self.trigger = Trigger(self.channels)
+        self.acceptor = Acceptor(sock, self)
+        host, port = sock.getsockname()[0:2]
+        self.base_environ = {'SERVER_NAME': socket.getfqdn(host),
+                             'SERVER_PORT': str(port), 'SCRIPT_NAME': '',
+                             'wsgi.version': (1, 0),
+                             'wsgi.url_scheme': 'http',
+                             'wsgi.errors': sys.stderr,
+                             'wsgi.multithread': True,
+                             'wsgi.multiprocess': True,
+                             'wsgi.run_once': False}
+        self._tasks = Queue()
+        for _ in xrange(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, func, *args):
+        self._tasks.put((func, args))
+
+    def _work(self):
+        while True:
+            func, args = self._tasks.get()
+            func(*args)
+
+    def _sweep(self, stopping):
+        idle_since = time.time() - self.keep_alive_timeout
+        for channel in self.channels.values():
+            if not isinstance(channel, Channel):
+                continue
+            if channel.parked is not None and channel.active_at < idle_since:
+                channel.handle_close()
+            elif not channel.busy and not channel.writable() and \
+                    (stopping or channel.active_at < idle_since):
+                channel.close()
+
+    def serve(self, stopping, limit):
+        while not stopping and (not limit or self.handled < limit):
+            asyncore.loop(timeout=1.0, use_poll=True, map=self.channels,
+                          count=1)
+            self._sweep(False)
+        self.acceptor.del_channel()
+        deadline = time.time() + 30
+        while time.time() < deadline and any(
+                isinstance(channel, Channel)
+                for channel in self.channels.itervalues()):
+            asyncore.loop(timeout=0.2, use_poll=True, map=self.channels,
+                          count=1)
+            self._sweep(True)
+
+
+class Master(object):
+    def __init__(self, blog, server, workers, max_requests, threads=0):
+        self.blog = blog
+        self.server = server
+        self.workers = workers
+        self.max_requests = max_requests
+        self.threads = threads
+        self.children = dict()
+        self.generation = 0
+        self.stopping = False
+        self.reloading = False
+        self._logger = logging.getLogger('serve')
+        self._main_index_path = os.path.join(blog.indices_dir, 'main.index')
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = self.generation
+            return
+        code = 0
+        try:
+            self.work()
+        except Exception:
+            self._logger.error('worker %d failed', os.getpid(), exc_info=1)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def work(self):
+        self.blog.watch_index = False
+        self.blog.refresh_entries = False
+        stopping = list()
+        signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        limit = 0
+        if self.max_requests:
+            limit = self.max_requests + random.randint(
+                0, self.max_requests // 10)
+        if self.threads:
+            EventLoopServer(self.server.socket, self.server.get_app(),
+                            self.threads).serve(stopping, limit)
+            return
+        while not stopping and (not limit or self.server.handled < limit):
+            self.server.handle_request()
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            self.children.pop(pid, None)
+
+    def index_changed(self):
+        try:
+            changed = self.blog.refresh_index()
+            if os.path.getmtime(self._main_index_path) != \
+                    self.blog._index_mtime:
+                self.blog._apply_index(
+                    *self.blog._try_main_index(self._main_index_path))
+                changed = True
+        except (IOError, OSError):
+            self._logger.error('IOError occurred while refreshing the index',
+                               exc_info=1)
+            return False
+        return changed
+
+    def reload(self):
+        self.reloading = False
+        self.generation += 1
+        self._logger.info('index changed, replacing workers (generation %d)',
+                          self.generation)
+        gc.collect()
+        for pid, generation in self.children.items():
+            if generation < self.generation:
+                self.signal(pid, signal.SIGTERM)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def run(self, check_interval):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        checked_at = time.time()
+        gc.collect()
+        while not self.stopping:
+            self.reap()
+            if time.time() - checked_at >= check_interval:
+                checked_at = time.time()
+                if self.index_changed():
+                    self.reloading = True
+            if self.reloading:
+                self.reload()
+            current = sum(1 for generation in self.children.itervalues()
+                          if generation == self.generation)
+            for _ in xrange(self.workers - current):
+                self.spawn()
+            time.sleep(0.2)
+        for pid in self.children.keys():
+            self.signal(pid, signal.SIGTERM)
+        while self.children:
+            try:
+                pid, _ = os.wait()
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            self.children.pop(pid, None)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _reload(self, signum, frame):
+        self.reloading = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves the blog with '
+                                                 'preforked workers that '
+                                                 'share the loaded index')
+    parser.add_argument('--host', default='')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('-w', '--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='recycle a worker after about this many '
+                             'requests')
+    parser.add_argument('-t', '--threads', type=int, default=0,
+                        help='serve connections from an event loop and '
+                             'run the application in this many threads')
+    parser.add_argument('--check-interval', type=float,
+                        help='seconds between index checks in the master')
+    args = parser.parse_args()
+    blog = index.application
+    server = PreforkServer((args.host, args.port), WSGIRequestHandler)
+    server.set_app(blog)
+    server.socket.setblocking(0)
+    master = Master(blog, server, args.workers, args.max_requests,
+                    args.threads)
+    master.run(args.check_interval if args.check_interval is not None
+               else blog.index_refresh_interval)
+
+
+if __name__ == '__main__':
+    main()